@@ -1,13 +1,18 @@
 import os
 
-from datetime import datetime
+from collections import OrderedDict
+from datetime import date, datetime
+from io import BytesIO
+from typing import AsyncIterable
 
 import matplotlib.pyplot as plt
+import numpy as np
 
+from decouple import config
 from matplotlib.dates import DateFormatter
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageDraw
 
-from api_handler import APICaller
+from assets_handler import assets
 from templates_handler import Constants
 from log_handler import Logger, LogTemplates
 
@@ -31,21 +36,45 @@ LOCALE = {
 }
 
 
+FORECAST_KEYS = ["distances", "times", "elevations"]
+# Converts the API units (meters and seconds) to km, hours and meters.
+UNITS = np.array([[1 / 1000], [1 / 3600], [1]])
+FORECAST_CACHE_SIZE = config("FORECAST_CACHE_SIZE", default=1000, cast=int)
+
+
+def forecast_period() -> tuple:
+    """Returns the timestamps of the current year start and now."""
+    before = int(datetime.now().timestamp())
+    after = int(datetime(datetime.now().year, 1, 1).timestamp())
+    return after, before
+
+
 class YearForecast:
-    def __init__(self, telegram_id: int, lang: str):
-        self.telegram_id = telegram_id
-        self.lang = lang
+    """Year forecast for the user. Activities of the current year are added
+    one by one with add_activity(), so they can be consumed from the API
+    page by page, then prepare() calculates the forecast data."""
 
-        caller = APICaller(telegram_id)
-        before = int(datetime.now().timestamp())
-        after = int(datetime(datetime.now().year, 1, 1).timestamp())
+    def __init__(self, telegram_id: int):
+        self.telegram_id = telegram_id
 
-        self.activities = caller.get_activities(after=after, before=before)
         self.stats_data = {
             "Ride": {"dates": [], "distances": [], "times": [], "elevations": []},
             "Run": {"dates": [], "distances": [], "times": [], "elevations": []},
         }
 
+    @classmethod
+    async def from_stream(
+        cls, telegram_id: int, activities: AsyncIterable
+    ) -> "YearForecast":
+        """Creates the forecast from the asynchronous stream of activities."""
+        forecast = cls(telegram_id)
+        async for activity in activities:
+            forecast.add_activity(activity)
+        forecast.prepare()
+        return forecast
+
+    def prepare(self):
+        """Prepares existing and forecast data after all activities were added."""
         self.prepare_exist_data()
 
         logger.debug(
@@ -61,77 +90,78 @@ class YearForecast:
 
         self.prepare_forecast_data()
 
+    def add_activity(self, activity: dict):
+        """Collects the raw stats from the activity summary, they are converted
+        all at once in prepare()."""
+        # Only runs and rides are forecasted.
+        stats = self.stats_data.get(activity.get("type"))
+        if stats is None:
+            return
+        try:
+            values = [
+                activity["start_date_local"][:10],
+                activity["distance"],
+                activity["moving_time"],
+                activity["total_elevation_gain"],
+            ]
+        except KeyError as error:
+            logger.error(
+                LogTemplates[__name__].BAD_ACTIVITY.format(activity.get("id"), error)
+            )
+            return
+        for key, value in zip(["dates", *FORECAST_KEYS], values):
+            stats[key].append(value)
+
     def prepare_exist_data(self):
-        for activity in self.activities:
-            activity_type = activity.get("type")
-            try:
-                self.stats_data[activity_type]["dates"].append(
-                    datetime.strptime(
-                        activity.get("start_date_local"), "%Y-%m-%dT%H:%M:%SZ"
-                    ).date()
-                )
-                self.stats_data[activity_type]["distances"].append(
-                    round(activity.get("distance") / 1000, 2)
-                )
-                self.stats_data[activity_type]["times"].append(
-                    round(activity.get("moving_time") / 3600, 1)
-                )
-                self.stats_data[activity_type]["elevations"].append(
-                    activity.get("total_elevation_gain")
-                )
-            except KeyError as error:
-                # log error
-                print(error)
-                pass
+        """Converts the stats to arrays in chronological order (the API returns
+        the newest activities first): dates are parsed from the ISO strings
+        and the metrics are converted to km, hours and meters."""
+        for act_type in self.stats_data.values():
+            act_type["dates"] = np.array(act_type["dates"][::-1], dtype="datetime64[D]")
+            metrics = np.array(
+                [act_type[key][::-1] for key in FORECAST_KEYS], dtype=float
+            )
+            for key, values in zip(FORECAST_KEYS, metrics * UNITS):
+                act_type[key] = values
         logger.debug(LogTemplates[__name__].READ_ACTIVITIES.format(self.telegram_id))
 
     def prepare_forecast_data(self):
-        forecast_keys = ["distances", "times", "elevations"]
+        """Calculates accumulated values and linear forecast to the end of the
+        year for all the metrics at once."""
+        last_day = np.datetime64(f"{datetime.now().year}-12-31", "D")
 
         for act_type in self.stats_data.values():
-            if not act_type["dates"] or len(act_type["dates"]) == 1:
+            dates = act_type["dates"]
+            if len(dates) < 2:
                 continue
 
-            last_date = act_type["dates"][-1]
-            last_day = datetime(datetime.now().year, 12, 31).date()
-
-            act_type["forecast_dates"] = [last_date, last_day]
-
-            days_left = (last_day - last_date).days
+            act_type["forecast_dates"] = np.array([dates[-1], last_day])
 
-            for key in forecast_keys:
+            days_passed = max((dates[-1] - dates[0]) // np.timedelta64(1, "D"), 1)
+            days_left = (last_day - dates[-1]) // np.timedelta64(1, "D")
 
-                accumulated_values = [
-                    round(sum(act_type[key][: i + 1]), 1)
-                    for i in range(len(act_type[key]))
-                ]
-
-                act_type[f"accumulated_{key}"] = accumulated_values
-
-                daily_increase = round(
-                    (
-                        (accumulated_values[-1] - accumulated_values[0])
-                        / (act_type["dates"][-1] - act_type["dates"][0]).days
-                    ),
-                    3,
-                )
-                logger.debug(
-                    LogTemplates[__name__].DAILY_INCREASE.format(daily_increase)
-                )
-                value_forecast = round(
-                    accumulated_values[-1] + daily_increase * days_left, 1
-                )
-
-                act_type[f"forecast_{key}"] = [accumulated_values[-1], value_forecast]
+            metrics = np.vstack([act_type[key] for key in FORECAST_KEYS])
+            accumulated = metrics.cumsum(axis=1)
+            daily_increase = (accumulated[:, -1] - accumulated[:, 0]) / days_passed
+            logger.debug(
+                LogTemplates[__name__].DAILY_INCREASE.format(daily_increase.round(3))
+            )
+            value_forecast = accumulated[:, -1] + daily_increase * days_left
 
-    def create_forecast(self, stat_type: str) -> str:
-        self.stat_type = stat_type
+            for key, values, forecast in zip(
+                FORECAST_KEYS, accumulated.round(1), value_forecast.round(1)
+            ):
+                act_type[f"accumulated_{key}"] = values
+                act_type[f"forecast_{key}"] = [float(values[-1]), float(forecast)]
 
+    def create_forecast(self, stat_type: str, lang: str) -> BytesIO:
+        """Creates the forecast image of the stat type in the language, the
+        forecast itself isn't changed, since it's shared by the requests."""
         run_data = self.stats_data["Run"]
         ride_data = self.stats_data["Ride"]
 
-        if not run_data.get("forecast_dates") and not ride_data.get("forecast_dates"):
-            print("HERE")
+        if "forecast_dates" not in run_data and "forecast_dates" not in ride_data:
+            logger.warning(LogTemplates[__name__].NO_FORECAST_DATA.format(stat_type))
             return
 
         fig, ax = plt.subplots(figsize=(9.6, 7.2))
@@ -141,20 +171,20 @@ class YearForecast:
         if len(run_data["dates"]) > 1:
             ax.plot(
                 run_data["dates"],
-                run_data[f"accumulated_{self.stat_type}"],
-                label=LOCALE[self.lang]["Run"],
+                run_data[f"accumulated_{stat_type}"],
+                label=LOCALE[lang]["Run"],
                 linewidth=3,
                 color="#555555",
             )
             ax.plot(
                 run_data["forecast_dates"],
-                run_data[f"forecast_{self.stat_type}"],
+                run_data[f"forecast_{stat_type}"],
                 linestyle="--",
                 linewidth=3,
                 color="#555555",
                 label=None,
             )
-            run_forecast_stat = round(run_data[f"forecast_{self.stat_type}"][-1])
+            run_forecast_stat = round(run_data[f"forecast_{stat_type}"][-1])
             ax.annotate(
                 f"{run_forecast_stat}",
                 xy=(run_data["forecast_dates"][-1], run_forecast_stat),
@@ -170,20 +200,20 @@ class YearForecast:
         if len(ride_data["dates"]) > 1:
             ax.plot(
                 ride_data["dates"],
-                ride_data[f"accumulated_{self.stat_type}"],
-                label=LOCALE[self.lang]["Ride"],
+                ride_data[f"accumulated_{stat_type}"],
+                label=LOCALE[lang]["Ride"],
                 linewidth=3,
                 color="white",
             )
             ax.plot(
                 ride_data["forecast_dates"],
-                ride_data[f"forecast_{self.stat_type}"],
+                ride_data[f"forecast_{stat_type}"],
                 linestyle="--",
                 linewidth=3,
                 color="white",
                 label=None,
             )
-            ride_forecast_stat = round(ride_data[f"forecast_{self.stat_type}"][-1])
+            ride_forecast_stat = round(ride_data[f"forecast_{stat_type}"][-1])
             ax.annotate(
                 f"{ride_forecast_stat}",
                 xy=(ride_data["forecast_dates"][-1], ride_forecast_stat),
@@ -214,46 +244,70 @@ class YearForecast:
 
         ax.legend(facecolor="none", frameon=False, fontsize=12, labelcolor="lightgrey")
 
-        self.graph_filepath = os.path.join(
-            Constants.IMAGE_PATH.value, f"{self.telegram_id}_{self.stat_type}_graph.png"
-        )
-
-        plt.savefig(self.graph_filepath)
+        graph = BytesIO()
+        fig.savefig(graph, format="png")
+        plt.close(fig)
+        graph.seek(0)
 
-        return self.add_images()
+        return self.add_images(graph, stat_type, lang)
 
-    def add_images(self):
-        forecast_image = Image.open(
+    def add_images(self, graph: BytesIO, stat_type: str, lang: str) -> BytesIO:
+        forecast_image = assets.image(
             os.path.join(Constants.FORECASTS_TEMPLATES.value, "forecast.png")
         )
 
-        header_font = ImageFont.truetype(
-            os.path.join(Constants.FONTS_DIR.value, "lsr.ttf"), 40
-        )
+        header_font = assets.font("lsr.ttf", 40)
 
         draw = ImageDraw.Draw(forecast_image)
 
         draw.text(
             (540, 90),
-            LOCALE[self.lang][self.stat_type].format(str(datetime.now().year)),
+            LOCALE[lang][stat_type].format(str(datetime.now().year)),
             font=header_font,
             fill="white",
             anchor="mm",
         )
 
-        graph_image = Image.open(self.graph_filepath).convert("RGBA")
+        graph_image = Image.open(graph).convert("RGBA")
 
         forecast_image.paste(graph_image, (60, 180, 1020, 900), mask=graph_image)
 
-        forecast_filepath = os.path.join(
-            Constants.IMAGE_PATH.value, f"{self.telegram_id}_{self.stat_type}.png"
-        )
+        forecast = BytesIO()
+        forecast_image.save(forecast, "PNG")
+        forecast.seek(0)
 
-        forecast_image.save(forecast_filepath)
+        return forecast
+
+
+class ForecastCache:
+    """Prepared forecasts of the users for the current day, so all the charts
+    requested during the day are rendered from one fetch of the activities.
+    The least recently used entries are evicted when the cache is full."""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.forecasts = OrderedDict()
+
+    def get(self, telegram_id: int) -> YearForecast | None:
+        entry = self.forecasts.get(telegram_id)
+        if entry is None:
+            return None
+        day, forecast = entry
+        if day != date.today():
+            del self.forecasts[telegram_id]
+            return None
+        self.forecasts.move_to_end(telegram_id)
+        logger.debug(LogTemplates[__name__].FORECAST_CACHED.format(telegram_id))
+        return forecast
+
+    def set(self, telegram_id: int, forecast: YearForecast) -> None:
+        self.forecasts[telegram_id] = (date.today(), forecast)
+        self.forecasts.move_to_end(telegram_id)
+        while len(self.forecasts) > self.max_size:
+            self.forecasts.popitem(last=False)
+
+    def invalidate(self, telegram_id: int) -> None:
+        self.forecasts.pop(telegram_id, None)
 
-        try:
-            os.remove(self.graph_filepath)
-        except FileNotFoundError:
-            pass
 
-        return forecast_filepath
+forecast_cache = ForecastCache(FORECAST_CACHE_SIZE)
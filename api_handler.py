@@ -1,23 +1,49 @@
-import os
-import requests
-import gpxpy.gpx
-
-import pandas as pd
+import asyncio
+import weakref
 
 from datetime import datetime, timedelta
+from decouple import config
 from inspect import stack
+from io import BytesIO, TextIOWrapper
+
+import store_handler
 
 from database_handler import DatabaseSession
-from token_handler import Token
+from http_handler import get_async_session, single_flight
+from ratelimit_handler import rate_limiter, INTERACTIVE, BACKGROUND
+from cache_handler import response_cache
+from token_handler import Token, token_cache
 from log_handler import Logger, LogTemplates
-from templates_handler import Urls, Constants
+from templates_handler import Urls
 
 logger = Logger(__name__)
 
+ACTIVITIES_PER_PAGE = 200
+ACTIVITIES_SYNC_INTERVAL = config(
+    'ACTIVITIES_SYNC_INTERVAL', default=60, cast=int)
+# Period of the activities synced first and longest period of the older
+# activities fetched at once by the background backfill.
+SYNC_BACKFILL_WINDOW = config(
+    'SYNC_BACKFILL_WINDOW', default=365 * 24 * 60 * 60, cast=int)
+GPX_STREAMS = {'keys': 'latlng,time,altitude', 'key_by_type': 'true'}
+GPX_HEADER = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<gpx xmlns="http://www.topografix.com/GPX/1/1" version="1.1" '
+    'creator="StravaGram">\n<trk>\n<trkseg>\n')
+GPX_POINT = '<trkpt lat="{}" lon="{}">{}<time>{}</time></trkpt>\n'
+GPX_ELEVATION = '<ele>{}</ele>'
+GPX_FOOTER = '</trkseg>\n</trk>\n</gpx>\n'
+# Locks of the sync state merges and background backfill tasks, keyed by
+# strava_id.
+sync_locks = weakref.WeakValueDictionary()
+backfills = {}
+
 
 class APICaller:
-    """Making calls to the Strava API, uses connections from the
-    DataBase class and token exchange procedures from the Token class."""
+    """Acquires the access token of the user from the token cache or the
+    database, refreshing it with the Token class if needed. The calls to
+    the API are made by the AsyncAPICaller, which goes through the rate
+    limiter, the response cache and single-flight."""
     def __init__(self, telegram_id: int):
         self.telegram_id = telegram_id
         logger.debug(LogTemplates[__name__].INIT.format(self.telegram_id))
@@ -28,126 +54,361 @@ class APICaller:
         self.headers = {'Authorization': 'Bearer {}'.format(self.access_token)}
 
     def get_access_token(self) -> None:
-        """Getting access token from the database.
+        """Getting access token from the token cache or from the database.
         If token expired launches the token exchange procedure
         and updates token in the database."""
-        check_session = DatabaseSession(self.telegram_id)
-        self.strava_id = check_session.strava_id
-        self.access_token = check_session.user.access_token
+        cached = token_cache.get(self.telegram_id)
+        if cached:
+            self.strava_id = cached['strava_id']
+            self.access_token = cached['access_token']
+            return
+        generation = token_cache.generation(self.telegram_id)
+        with DatabaseSession(self.telegram_id) as check_session:
+            self.strava_id = check_session.strava_id
+            self.access_token = check_session.user.access_token
+            token_expired = check_session.token_expired()
+            refresh_token = check_session.user.refresh_token
+            expires_at = check_session.user.expires_at
         logger.debug(
             LogTemplates[__name__].ACCESS_TOKEN.format(self.access_token))
-        if check_session.token_expired():
+        if token_expired:
             logger.debug(
                 LogTemplates[__name__].TOKEN_EXPIRED.format(self.telegram_id))
-            refresh_token = check_session.get_token()
             token = Token(self.telegram_id, refresh_token=refresh_token)
-            check_session.disconnect()
             auth_data = token.exchange()
             if auth_data:
-                update_session = DatabaseSession(self.telegram_id)
-                update_session.update_user(auth_data)
-                self.access_token = update_session.user.access_token
+                with DatabaseSession(self.telegram_id) as update_session:
+                    updated = update_session.refresh_user(
+                        auth_data, self.strava_id, refresh_token)
+                if not updated:
+                    # Re-authorized in the meantime, the new tokens are
+                    # read on the next call.
+                    return
+                self.access_token = auth_data['access_token']
+                refresh_token = auth_data['refresh_token']
+                expires_at = auth_data['expires_at']
                 logger.debug(
                     LogTemplates[__name__].TOKEN_UPDATED.format(
                         self.access_token))
-                update_session.disconnect()
             else:
                 logger.error(
                     LogTemplates[__name__].UPDATE_TOCKEN_FAILED.format(
                         self.telegram_id))
                 return
+        token_cache.set(self.telegram_id, self.strava_id, self.access_token,
+                        refresh_token, expires_at, generation)
+
+
+class AsyncAPICaller:
+    """Making calls to the Strava API with the token from the APICaller.
+    Uses the shared aiohttp session, so the calls don't block the event loop.
+    Should be created with the create() coroutine. All the calls go through
+    the rate limiter with the priority of the caller."""
+    def __init__(self, telegram_id: int, priority: int = INTERACTIVE):
+        self.telegram_id = telegram_id
+        self.priority = priority
+        self.strava_id = None
+        self.access_token = None
+        self.headers = {}
+
+    @classmethod
+    async def create(cls, telegram_id: int,
+                     priority: int = INTERACTIVE) -> 'AsyncAPICaller':
+        """Creates the caller and acquires the access token."""
+        caller = cls(telegram_id, priority)
+        await caller.get_access_token()
+        return caller
+
+    async def get_access_token(self) -> None:
+        """Acquires the access token (and refreshes it if needed) with the
+        synchronous APICaller in a separate thread."""
+        sync_caller = await asyncio.to_thread(APICaller, self.telegram_id)
+        self.strava_id = sync_caller.strava_id
+        self.access_token = sync_caller.access_token
+        self.headers = sync_caller.headers
+
+    async def request(self, url: str, params: dict = None) -> dict | list:
+        """Makes GET request to the API and returns decoded JSON
+        or None if the response is bad."""
+        await rate_limiter.acquire(self.telegram_id, self.priority)
+        session = get_async_session()
+        async with session.get(url, params=params,
+                               headers=self.headers) as response:
+            rate_limiter.update(response.headers)
+            if response.status == 200:
+                return await response.json()
+            if response.status == 429:
+                rate_limiter.exhaust()
+            logger.warning(
+                LogTemplates[__name__].BAD_RESPONSE.format(
+                    self.telegram_id, await response.text()))
 
-    def get_stats(self) -> dict:
+    async def get_stats(self) -> dict:
         """Makes call to the API to recieve athlete's stats."""
-        url = Urls.GET_STATS.format(self.strava_id)
         logger.debug(LogTemplates[__name__].FUNCTION_INIT.format(
             stack()[0][3], self.telegram_id))
-        response = requests.get(url, headers=self.headers)
-        if response.status_code == 200:
-            return response.json()
-        else:
-            logger.warning(
-                LogTemplates[__name__].BAD_RESPONSE.format(self.telegram_id,
-                                                           response.text))
+        return await self.cached(
+            'get_stats', (self.strava_id,), Urls.GET_STATS.format(
+                self.strava_id))
 
-    def raw_data(self, **kwargs) -> dict:
+    async def raw_data(self, **kwargs) -> dict:
         """Making simple API calls and returns dict with raw data."""
-        url = Urls[list(kwargs.keys())[0]].format(*kwargs.values())
+        endpoint = list(kwargs.keys())[0]
+        url = Urls[endpoint].format(*kwargs.values())
         logger.debug(LogTemplates[__name__].FUNCTION_INIT.format(
             stack()[0][3], self.telegram_id))
-        response = requests.get(url, headers=self.headers)
-        if response.status_code == 200:
-            return response.json()
-        else:
-            logger.warning(
-                LogTemplates[__name__].BAD_RESPONSE.format(self.telegram_id,
-                                                           response.text))
+        return await self.cached(endpoint, tuple(kwargs.values()), url)
+
+    async def get_streams(self, activity_id: int) -> dict:
+        """Makes call to the API to recieve the streams used for GPX."""
+        return await self.cached(
+            'get_streams', (activity_id,),
+            Urls.CREATE_GPX.format(activity_id), GPX_STREAMS)
 
-    def get_activities(self, after: int = None, before: int = None) -> list:
+    async def cached(self, endpoint: str, args: tuple, url: str,
+                     params: dict = None) -> dict:
+        """Returns the response from the cache or requests it from the API
+        and caches it. Identical concurrent requests with the same priority
+        share one call, so an interactive request never waits for a
+        background one held back by the rate limiter."""
+        data = await response_cache.get(self.telegram_id, endpoint, args)
+        if data is None:
+            data = await single_flight.do(
+                ('request', self.strava_id, self.priority, url, str(params)),
+                self.request, url, params)
+            await response_cache.set(self.telegram_id, endpoint, args, data)
+        return data
+
+    async def get_activities(self, after: int = None,
+                             before: int = None) -> list:
         """Returns the list of the activities
-        in the specified period of time"""
-        url = Urls.GET_ACTIVITIES
+        in the specified period of time. Identical concurrent calls
+        share one query."""
+        return await single_flight.do(
+            ('get_activities', self.strava_id, after, before),
+            self.collect_activities, after, before)
+
+    async def collect_activities(self, after: int, before: int) -> list:
+        """Collects the activities from iter_activities() to the list."""
+        activities = [activity async for activity in self.iter_activities(
+            after=after, before=before)]
+        return activities[::-1]
+
+    async def iter_activities(self, after: int = None, before: int = None,
+                              prefetch: int = 0):
+        """Yields the activities in the specified period of time from the
+        local activity store, in the same order as the API returns them.
+        The store is synced with the API before the query."""
         logger.debug(LogTemplates[__name__].FUNCTION_INIT.format(
             stack()[0][3], self.telegram_id))
-        # If period of time wasn't specified, using 60 days before now.
-        if not after and not before:
-            before = int(datetime.now().timestamp())
-            after = before - (60 * 24 * 60 * 60)
-        params = {
-            'before': before,
-            'after': after,
-            'page': '1',
-            'per_page': '180'}
-        response = requests.get(url, params=params, headers=self.headers)
-        if response.status_code == 200:
-            return response.json()[::-1]
+        after, before = activities_period(after, before)
+        await self.sync_activities(after or 0, before, prefetch=prefetch)
+        activities = await asyncio.to_thread(
+            store_handler.get_activities, self.strava_id, after, before)
+        for activity in activities:
+            yield activity
+
+    async def sync_activities(self, after: int, before: int = None,
+                              prefetch: int = 0) -> bool:
+        """Incrementally syncs the local activity store with the API, so it
+        holds all the activities of the period: fetches the activities after
+        the last seen start date and the part of the period before the
+        earliest synced time. The period, which doesn't adjoin the synced
+        span, is fetched exactly and the span is extended to it in the
+        background. Returns False if the API returned bad response."""
+        now = int(datetime.now().timestamp())
+        sync = await asyncio.to_thread(store_handler.get_sync, self.strava_id)
+        if sync:
+            synced_from = sync['synced_from']
+            periods = []
+            if now - sync['synced_at'] > ACTIVITIES_SYNC_INTERVAL:
+                periods.append((sync['last_start'], None))
         else:
-            logger.warning(
-                LogTemplates[__name__].BAD_RESPONSE.format(self.telegram_id,
-                                                           response.text))
+            synced_from = max(after, now - SYNC_BACKFILL_WINDOW)
+            periods = [(synced_from, None)]
+        backfill = after < synced_from and before and before <= synced_from
+        if backfill:
+            periods.append((after, before))
+        elif after < synced_from:
+            periods.append((after, synced_from + 1))
+        for period_after, period_before in periods:
+            logger.debug(LogTemplates[__name__].ACTIVITIES_SYNC.format(
+                self.telegram_id, period_after, period_before))
+            if not await self.store_period(
+                    period_after, period_before, prefetch=prefetch):
+                return False
+        if backfill:
+            self.start_backfill(after)
+        return True
 
-    def create_gpx(self, activity_id: int) -> str:
-        """Creates GPX files from API streams request,
-        returns the path to the file."""
+    async def store_period(self, after: int, before: int = None,
+                           prefetch: int = 0) -> bool:
+        """Fetches the activities of the period to the store, then merges
+        the period to the sync state. Returns False if the API returned bad
+        response, the sync state isn't changed then."""
+        fetched_at = int(datetime.now().timestamp())
+        last_start = after
+        async for page in self.fetch_activities(
+                after, before, prefetch=prefetch):
+            if page is None:
+                return False
+            last_start = max(
+                [last_start, *map(store_handler.start_timestamp, page)])
+            await asyncio.to_thread(
+                store_handler.save_activities, self.strava_id, page)
+        await self.merge_sync(after, before, last_start, fetched_at)
+        return True
+
+    async def merge_sync(self, after: int, before: int | None,
+                         last_start: int, fetched_at: int) -> None:
+        """Merges the fetched period to the sync state of the athlete, the
+        synced span is extended only by the period adjoining it. Only the
+        merge holds the lock, so the background fetch waiting for the rate
+        limiter doesn't hold up the requests of the athlete."""
+        async with sync_lock(self.strava_id):
+            sync = await asyncio.to_thread(
+                store_handler.get_sync, self.strava_id)
+            if not sync:
+                if before is not None:
+                    return
+                sync = {'synced_from': after, 'last_start': after,
+                        'synced_at': 0}
+            if before is None:
+                sync['last_start'] = max(sync['last_start'], last_start)
+                sync['synced_at'] = max(sync['synced_at'], fetched_at)
+            elif before > sync['synced_from']:
+                sync['synced_from'] = min(sync['synced_from'], after)
+            else:
+                return
+            await asyncio.to_thread(
+                store_handler.save_sync, self.strava_id, sync)
+
+    def start_backfill(self, after: int) -> None:
+        """Starts fetching the activities back to after in the background,
+        unless it's already running for the athlete."""
+        if self.strava_id in backfills:
+            return
+        strava_id = self.strava_id
+        backfills[strava_id] = asyncio.create_task(
+            self.backfill_activities(after))
+        backfills[strava_id].add_done_callback(
+            lambda _: backfills.pop(strava_id, None))
+
+    async def backfill_activities(self, after: int) -> None:
+        """Extends the synced span back to after window by window with the
+        background priority, so it doesn't hold up the requests of the
+        users."""
+        try:
+            caller = await AsyncAPICaller.create(
+                self.telegram_id, BACKGROUND)
+            while True:
+                sync = await asyncio.to_thread(
+                    store_handler.get_sync, self.strava_id)
+                if not sync or sync['synced_from'] <= after:
+                    return
+                synced_from = sync['synced_from']
+                period_after = max(
+                    after, synced_from - SYNC_BACKFILL_WINDOW)
+                if not await caller.store_period(
+                        period_after, synced_from + 1):
+                    return
+        except Exception as error:
+            logger.error(LogTemplates[__name__].BACKFILL_FAILED.format(
+                self.telegram_id, error))
+
+    async def fetch_activities(self, after: int, before: int = None,
+                               per_page: int = ACTIVITIES_PER_PAGE,
+                               prefetch: int = 0):
+        """Yields pages of the activities from the API in the specified
+        period of time, or None if the API returned bad response. Requests
+        up to prefetch next pages concurrently while the current one is
+        consumed."""
+        url = Urls.GET_ACTIVITIES.value
+        params = activities_params(after, before, per_page)
+        pages = {}
+        try:
+            while True:
+                for page in range(params['page'],
+                                  params['page'] + prefetch + 1):
+                    if page not in pages:
+                        pages[page] = asyncio.create_task(
+                            self.request(url, {**params, 'page': page}))
+                activities = await pages.pop(params['page'])
+                yield activities
+                if activities is None or len(activities) < per_page:
+                    return
+                params['page'] += 1
+        finally:
+            for task in pages.values():
+                task.cancel()
+
+    async def create_gpx(self, activity_id: int) -> BytesIO:
+        """Creates GPX file in memory from API streams request."""
         logger.debug(LogTemplates[__name__].GPX_STARTED.format(activity_id))
-        start_time = self.raw_data(
-            get_activity=activity_id).get('start_date_local')
-        url = Urls.CREATE_GPX.format(activity_id)
+        activity, streams = await asyncio.gather(
+            self.raw_data(get_activity=activity_id),
+            self.get_streams(activity_id))
         try:
-            latlong = requests.get(
-                url, headers=self.headers,
-                params={'keys': ['latlng']}).json()[0]['data']
-            time_list = requests.get(
-                url, headers=self.headers,
-                params={'keys': ['time']}).json()[1]['data']
-            altitude = requests.get(
-                url, headers=self.headers,
-                params={'keys': ['altitude']}).json()[1]['data']
+            return write_gpx(
+                activity_id, activity.get('start_date_local'), streams)
         except Exception:
             logger.error(LogTemplates[__name__].GPX_RETRIEVE_ERROR.format(
                 activity_id))
-            return None
-
-        data = pd.DataFrame([*latlong], columns=['lat', 'long'])
-        data['altitude'] = altitude
-        start = datetime.strptime(start_time, "%Y-%m-%dT%H:%M:%SZ")
-        data['time'] = [(start+timedelta(seconds=t)) for t in time_list]
-
-        gpx = gpxpy.gpx.GPX()
-        gpx_track = gpxpy.gpx.GPXTrack()
-        gpx.tracks.append(gpx_track)
-        gpx_segment = gpxpy.gpx.GPXTrackSegment()
-        gpx_track.segments.append(gpx_segment)
-        for idx in data.index:
-            gpx_segment.points.append(gpxpy.gpx.GPXTrackPoint(
-                                      data.loc[idx, 'lat'],
-                                      data.loc[idx, 'long'],
-                                      elevation=data.loc[idx, 'altitude'],
-                                      time=data.loc[idx, 'time']))
-
-        filepath = os.path.join(
-            Constants.ABSOLUTE_PATH.value, 'gpx/{}.gpx'.format(activity_id))
-        with open(filepath, 'w') as gpxf:
-            gpxf.write(gpx.to_xml())
-        logger.info(LogTemplates[__name__].GPX_CREATED.format(filepath))
-        return filepath
+
+
+def sync_lock(strava_id: int) -> asyncio.Lock:
+    """Returns the lock of the activity sync of the athlete, the lock is
+    dropped when no sync holds or waits for it."""
+    lock = sync_locks.get(strava_id)
+    if lock is None:
+        lock = sync_locks[strava_id] = asyncio.Lock()
+    return lock
+
+
+def activities_period(after: int, before: int) -> tuple:
+    """Returns after and before timestamps for the activities request.
+    If period of time wasn't specified, using 60 days before now."""
+    if not after and not before:
+        before = int(datetime.now().timestamp())
+        after = before - (60 * 24 * 60 * 60)
+    return after, before
+
+
+def activities_params(after: int, before: int, per_page: int) -> dict:
+    """Returns query parameters for the first page of the activities."""
+    params = {'page': 1, 'per_page': per_page}
+    if after:
+        params['after'] = int(after)
+    if before:
+        params['before'] = int(before)
+    return params
+
+
+def write_gpx(activity_id: int, start_time: str, streams: dict) -> BytesIO:
+    """Writes GPX file from the streams data (keyed by type) point by point
+    to the memory buffer, returns the buffer ready for reading."""
+    start = datetime.strptime(start_time, "%Y-%m-%dT%H:%M:%SZ")
+    latlong = streams['latlng']['data']
+    time_list = streams['time']['data']
+    altitude = streams.get('altitude', {}).get('data') or [None] * len(latlong)
+
+    gpx = BytesIO()
+    gpxf = TextIOWrapper(gpx, encoding='utf-8')
+    gpxf.write(GPX_HEADER)
+    gpxf.writelines(
+        gpx_point(lat, long, elevation, start + timedelta(seconds=t))
+        for (lat, long), elevation, t in zip(latlong, altitude, time_list))
+    gpxf.write(GPX_FOOTER)
+    gpxf.detach()
+    gpx.seek(0)
+    logger.info(LogTemplates[__name__].GPX_CREATED.format(activity_id))
+    return gpx
+
+
+def gpx_point(lat: float, long: float, elevation: float,
+              time: datetime) -> str:
+    """Returns the XML string for the single track point."""
+    elevation = GPX_ELEVATION.format(elevation) if elevation is not None \
+        else ''
+    return GPX_POINT.format(lat, long, elevation,
+                            time.strftime("%Y-%m-%dT%H:%M:%SZ"))
@@ -0,0 +1,59 @@
+import os
+
+from PIL import Image, ImageFont
+
+from templates_handler import Constants
+from log_handler import Logger, LogTemplates
+
+logger = Logger(__name__)
+
+TEMPLATES_DIRS = [
+    Constants.STORIES_TEMPLATES.value,
+    Constants.FORECASTS_TEMPLATES.value,
+]
+
+
+class Assets:
+    """Registry of the template images and fonts used for rendering. Images
+    are decoded once and every render gets its own copy, fonts are shared,
+    since drawing doesn't change them."""
+
+    def __init__(self):
+        self.images = {}
+        self.fonts = {}
+
+    def load(self) -> None:
+        """Decodes all the template images, used at the render worker startup."""
+        for templates_dir in TEMPLATES_DIRS:
+            for filename in sorted(os.listdir(templates_dir)):
+                if filename.endswith(".png"):
+                    self.load_image(os.path.join(templates_dir, filename))
+        logger.debug(LogTemplates[__name__].ASSETS_LOADED.format(len(self.images)))
+
+    def load_image(self, filepath: str) -> Image.Image:
+        image = Image.open(filepath)
+        image.load()
+        self.images[filepath] = image
+        return image
+
+    def image(self, filepath: str) -> Image.Image:
+        """Returns a copy of the template image, which can be drawn on."""
+        image = self.images.get(filepath) or self.load_image(filepath)
+        return image.copy()
+
+    def font(self, filename: str, size: int) -> ImageFont.FreeTypeFont:
+        """Returns the font from the fonts directory with the size."""
+        key = (filename, size)
+        if key not in self.fonts:
+            self.fonts[key] = ImageFont.truetype(
+                os.path.join(Constants.FONTS_DIR.value, filename), size
+            )
+        return self.fonts[key]
+
+
+assets = Assets()
+
+
+def load_assets() -> None:
+    """Loads the assets of the process, used as the render worker initializer."""
+    assets.load()
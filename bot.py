@@ -1,15 +1,15 @@
 import asyncio
+import functools
 import re
 import json
 import os
 
-from multiprocessing import Process
 from aiogram import Bot, Dispatcher, executor, types
-from aiogram.contrib.fsm_storage.memory import MemoryStorage
 from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters.state import State, StatesGroup
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton
+from aiohttp import web
 from decouple import config
 from datetime import datetime
 from pydantic import BaseModel
@@ -17,13 +17,27 @@ from pydantic import BaseModel
 import format_handler as formatter
 
 from webhook_handler import WebHook
-from database_handler import DatabaseSession
-from flask_server import run_server
+from database_handler import DatabaseSession, migrate
 from templates_handler import startup, Constants, Urls
-from api_handler import APICaller
+from api_handler import AsyncAPICaller
 from log_handler import Logger, get_log_file, LogTemplates
-from image_handler import Stories
-from analytics_handler import YearForecast
+from analytics_handler import (
+    FORECAST_KEYS,
+    YearForecast,
+    forecast_cache,
+    forecast_period,
+)
+from http_handler import close_async_session
+from token_handler import refresh_tokens
+from ratelimit_handler import rate_limiter
+from events_handler import process_events, remember_lang
+from image_handler import story_key
+from story_cache_handler import story_cache
+from file_id_handler import artifact_key, get_file_id, save_file_id, purge_expired
+from render_handler import RenderBusy, render_service, render_story, render_forecasts
+from web_server import start_server, stop_server
+from fsm_storage_handler import storage, purge_states
+from janitor_handler import run_janitor
 
 logger = Logger("bot")
 TOKEN = config("TOKEN")
@@ -32,10 +46,122 @@ BOT_TEMPLATES = os.path.join(
 )
 BUTTON_TEMPLATES = os.path.join(Constants.ABSOLUTE_PATH.value, "templates/buttons.json")
 ADMIN = int(config("ADMIN"))
+# Public URL of the server, the bot receives updates with webhook if it's set,
+# otherwise with long polling.
+WEBHOOK_URL = config("TELEGRAM_WEBHOOK_URL", default=None)
+WEBHOOK_PATH = config("TELEGRAM_WEBHOOK_PATH", default="/telegram")
+WEBHOOK_PORT = config("TELEGRAM_WEBHOOK_PORT", default=8080, cast=int)
+WEBHOOK_SECRET = config("TELEGRAM_WEBHOOK_SECRET", default=None)
+UPDATES_CONCURRENCY = config("UPDATES_CONCURRENCY", default=40, cast=int)
+SHUTDOWN_TIMEOUT = config("SHUTDOWN_TIMEOUT", default=30, cast=int)
+# Maximum number of the expensive jobs (stories, GPX files and forecasts)
+# in process for one user and for all the users.
+USER_JOBS_LIMIT = config("USER_JOBS_LIMIT", default=2, cast=int)
+JOBS_LIMIT = config("JOBS_LIMIT", default=20, cast=int)
+
+
+class UpdatesLimiter:
+    """Limits the number of updates processed at the same time and keeps
+    track of them, so the bot can finish them before shutdown. Used as an
+    async context manager, so the slot is released however the update ends."""
+
+    def __init__(self, limit: int):
+        self.semaphore = asyncio.Semaphore(limit)
+        self.active = 0
+        self.idle = asyncio.Event()
+        self.idle.set()
+
+    async def __aenter__(self):
+        await self.semaphore.acquire()
+        self.active += 1
+        self.idle.clear()
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.semaphore.release()
+        self.active -= 1
+        if not self.active:
+            self.idle.set()
+
+    async def wait_idle(self, timeout: int) -> None:
+        """Waits until all the updates in process are finished."""
+        try:
+            await asyncio.wait_for(self.idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(LogTemplates["bot"].UPDATES_ABANDONED.format(self.active))
+
+
+class JobsLimiter:
+    """Admission control of the expensive jobs, which call the API and render
+    images. A job is admitted only if it isn't in process already and the
+    user and the bot are below the limits of the jobs in process, so one
+    user can't take all the API calls and the renderers."""
+
+    def __init__(self, user_limit: int, limit: int):
+        self.user_limit = user_limit
+        self.limit = limit
+        self.jobs = {}
+        self.active = 0
+
+    def admit(self, telegram_id: int, job: str) -> str | None:
+        """Starts the job, returns the name of the message with the reason
+        if the job is rejected."""
+        user_jobs = self.jobs.get(telegram_id, set())
+        if job in user_jobs:
+            return "JOB_IN_PROGRESS"
+        if len(user_jobs) >= self.user_limit:
+            return "TOO_MANY_JOBS"
+        if self.active >= self.limit:
+            return "JOBS_BUSY"
+        self.jobs.setdefault(telegram_id, set()).add(job)
+        self.active += 1
+
+    def release(self, telegram_id: int, job: str) -> None:
+        self.jobs[telegram_id].discard(job)
+        if not self.jobs[telegram_id]:
+            del self.jobs[telegram_id]
+        self.active -= 1
+
+
+class LimitedDispatcher(Dispatcher):
+    """Dispatcher, which processes the updates within the concurrency limit.
+    The slot is taken after the update middlewares, so an update cancelled
+    by them never holds it."""
+
+    async def process_update(self, update: types.Update):
+        async with concurrency:
+            return await super().process_update(update)
+
 
-storage = MemoryStorage()
 bot = Bot(token=TOKEN)
-dp = Dispatcher(bot=bot, storage=storage)
+concurrency = UpdatesLimiter(UPDATES_CONCURRENCY)
+dp = LimitedDispatcher(bot=bot, storage=storage)
+jobs_limiter = JobsLimiter(USER_JOBS_LIMIT, JOBS_LIMIT)
+background_tasks = []
+
+
+def expensive_job(handler):
+    """Runs the callback handler under admission control. Identical pending
+    jobs are the same callback data from the same user, instead of starting
+    them again the user gets the "still working" reply."""
+
+    @functools.wraps(handler)
+    async def wrapper(callback_query: types.CallbackQuery):
+        telegram_id = callback_query.from_user.id
+        job = callback_query.data
+        rejection = jobs_limiter.admit(telegram_id, job)
+        if rejection:
+            _, lang, _ = unpack_message(callback_query)
+            logger.debug(
+                LogTemplates["bot"].JOB_REJECTED.format(job, telegram_id, rejection)
+            )
+            await callback_query.answer(getattr(BOT_MESSAGES[lang], rejection))
+            return
+        try:
+            await handler(callback_query)
+        finally:
+            jobs_limiter.release(telegram_id, job)
+
+    return wrapper
 
 
 class Form(StatesGroup):
@@ -67,6 +193,7 @@ class MessageModel(BaseModel):
     FORECAST_DISTANCE: str
     FORECAST_TIME: str
     FORECAST_ELEVATION: str
+    FORECAST_ALL: str
     CHOOSE_FORECAST: str
     NO_FORECAST: str
     NO_STORY: str
@@ -79,6 +206,11 @@ class MessageModel(BaseModel):
     WH_VIEW_BAD: str
     WH_DEL_GOOD: str
     WH_DEL_BAD: str
+    RATE_LIMITS: str
+    RENDER_BUSY: str
+    JOB_IN_PROGRESS: str
+    TOO_MANY_JOBS: str
+    JOBS_BUSY: str
 
 
 class ButtonModel(BaseModel):
@@ -167,9 +299,8 @@ async def users_handler(message: types.Message):
     Only available for admin user."""
     telegram_id, lang, user_name = unpack_message(message)
     if telegram_id == ADMIN:
-        users_session = DatabaseSession(telegram_id)
-        users = users_session.get_users()
-        users_session.disconnect()
+        with DatabaseSession(telegram_id) as users_session:
+            users = users_session.get_users()
         formatted_message = formatter.format_users(users)
         await bot.send_message(
             telegram_id,
@@ -188,6 +319,17 @@ async def logs_handler(message: types.Message):
         await bot.send_document(telegram_id, log_file)
 
 
+@dp.message_handler(commands=["limits"])
+async def limits_handler(message: types.Message):
+    """Returns current usage of Strava API rate limits.
+    Only available for admin user."""
+    telegram_id, lang, user_name = unpack_message(message)
+    if telegram_id == ADMIN:
+        await bot.send_message(
+            telegram_id, BOT_MESSAGES[lang].RATE_LIMITS.format(**rate_limiter.status())
+        )
+
+
 @dp.message_handler(regexp_commands=[r"/webhook?(?P<action>\w+)"])
 async def webhook_handler(message: types.Message, regexp_command: re.Match[str]):
     """Handles operations with Strava webhook subscription (subscribe,
@@ -241,13 +383,16 @@ async def find_finish(message_text, telegram_id, lang, state):
             parse_mode="MarkdownV2",
             reply_markup=generate_reply_keyboard(BUTTONS[lang].activities_menu()),
         )
-        caller = APICaller(telegram_id=telegram_id)
-        raw_data = caller.get_activities(before=before, after=after)
+        caller = await AsyncAPICaller.create(telegram_id)
+        data = {}
+        async for activity in caller.iter_activities(before=before, after=after):
+            data.update(formatter.format_activities([activity], lang))
         await state.finish()
-        if not raw_data:
+        if not data:
             await bot.send_message(telegram_id, BOT_MESSAGES[lang].NO_ACTIVITIES)
         else:
-            data = formatter.format_activities(raw_data, lang)
+            # Same order as get_activities() returns, reversed to the API order.
+            data = dict(reversed(data.items()))
             await bot.send_message(
                 telegram_id,
                 BOT_MESSAGES[lang].FOUND.format(message_text),
@@ -350,8 +495,8 @@ async def auth_button_handler(message_text, telegram_id, lang):
 
 
 async def starred_segments_button_handler(message_text, telegram_id, lang):
-    caller = APICaller(telegram_id)
-    segments = caller.raw_data(get_starred_segments=True)
+    caller = await AsyncAPICaller.create(telegram_id)
+    segments = await caller.raw_data(get_starred_segments=True)
     if not segments:
         await bot.send_message(telegram_id, BOT_MESSAGES[lang].NO_STARRED_SEG)
         return
@@ -366,9 +511,9 @@ async def starred_segments_button_handler(message_text, telegram_id, lang):
 
 
 async def stats_buttons_handler(message_text, telegram_id, lang):
-    caller = APICaller(telegram_id=telegram_id)
+    caller = await AsyncAPICaller.create(telegram_id)
     period = BUTTONS[lang].periods().get(message_text)
-    raw_data = caller.get_stats()
+    raw_data = await caller.get_stats()
     if raw_data:
         data = formatter.format_stats(raw_data, period, lang)
         await bot.send_message(telegram_id, data, parse_mode="MarkdownV2")
@@ -377,8 +522,8 @@ async def stats_buttons_handler(message_text, telegram_id, lang):
 
 
 async def recent_button_handler(message_text, telegram_id, lang):
-    caller = APICaller(telegram_id)
-    raw_data = caller.get_activities()
+    caller = await AsyncAPICaller.create(telegram_id)
+    raw_data = await caller.get_activities()
     if raw_data:
         data = formatter.format_activities(raw_data, lang)
         await bot.send_message(
@@ -392,8 +537,8 @@ async def recent_button_handler(message_text, telegram_id, lang):
 
 
 async def last_button_handler(message_text, telegram_id, lang):
-    caller = APICaller(telegram_id)
-    activities = caller.get_activities()
+    caller = await AsyncAPICaller.create(telegram_id)
+    activities = await caller.get_activities()
     if not activities:
         await bot.send_message(telegram_id, BOT_MESSAGES[lang].NO_ACTIVITIES)
         return
@@ -406,7 +551,7 @@ async def last_button_handler(message_text, telegram_id, lang):
     }
     inline_keyboard = generate_inline_keyboard(inline_buttons)
 
-    raw_data = caller.raw_data(get_activity=activity_id)
+    raw_data = await caller.raw_data(get_activity=activity_id)
     if raw_data:
         data = formatter.format_activity(raw_data, lang)
         await bot.send_message(
@@ -431,6 +576,7 @@ async def year_forecast_button_handler(message_text, telegram_id, lang):
         "forecast_distances": BOT_MESSAGES[lang].FORECAST_DISTANCE,
         "forecast_times": BOT_MESSAGES[lang].FORECAST_TIME,
         "forecast_elevations": BOT_MESSAGES[lang].FORECAST_ELEVATION,
+        "forecast_all": BOT_MESSAGES[lang].FORECAST_ALL,
     }
     inline_keyboard = generate_inline_keyboard(inline_buttons)
 
@@ -465,8 +611,8 @@ async def activity_callback(callback_query: types.CallbackQuery):
     }
     inline_keyboard = generate_inline_keyboard(inline_buttons)
 
-    caller = APICaller(telegram_id)
-    raw_data = caller.raw_data(get_activity=activity_id)
+    caller = await AsyncAPICaller.create(telegram_id)
+    raw_data = await caller.raw_data(get_activity=activity_id)
     if raw_data:
         data = formatter.format_activity(raw_data, lang)
         await bot.send_message(
@@ -477,28 +623,26 @@ async def activity_callback(callback_query: types.CallbackQuery):
 
 
 @dp.callback_query_handler(text_contains="gpx")
+@expensive_job
 async def gpx_callback(callback_query: types.CallbackQuery):
     telegram_id, lang, user_name = unpack_message(callback_query)
     activity_id = callback_query.data.split("gpx")[1]
 
-    caller = APICaller(telegram_id)
-    filepath = caller.create_gpx(activity_id)
-
-    if filepath:
-        file = types.InputFile(filepath)
-        await bot.send_document(telegram_id, file)
+    key = artifact_key(telegram_id, "activity", activity_id, "gpx")
+    if await send_cached(telegram_id, key, bot.send_document):
         logger.debug(LogTemplates["bot"].GPX_SENT.format(telegram_id))
-    else:
-        await bot.send_message(telegram_id, BOT_MESSAGES[lang].BAD_GPX_REQUEST)
         return
 
-    await asyncio.sleep(60)
+    caller = await AsyncAPICaller.create(telegram_id)
+    gpx = await caller.create_gpx(activity_id)
 
-    try:
-        os.remove(filepath)
-        logger.debug(LogTemplates["bot"].GPX_DELETED.format(filepath))
-    except FileNotFoundError:
-        logger.error(LogTemplates["bot"].CANT_DELETE_GPX.format(filepath))
+    if gpx:
+        file = types.InputFile(gpx, filename=f"{activity_id}.gpx")
+        sent = await bot.send_document(telegram_id, file)
+        await asyncio.to_thread(save_file_id, key, sent.document.file_id)
+        logger.debug(LogTemplates["bot"].GPX_SENT.format(telegram_id))
+    else:
+        await bot.send_message(telegram_id, BOT_MESSAGES[lang].BAD_GPX_REQUEST)
 
 
 @dp.callback_query_handler(text_contains="actseg")
@@ -506,8 +650,8 @@ async def actseg_callback(callback_query: types.CallbackQuery):
     telegram_id, lang, user_name = unpack_message(callback_query)
     activity_id = callback_query.data.split("actseg")[1]
 
-    caller = APICaller(telegram_id)
-    raw_data = caller.raw_data(get_activity=activity_id)
+    caller = await AsyncAPICaller.create(telegram_id)
+    raw_data = await caller.raw_data(get_activity=activity_id)
 
     segments = raw_data["segment_efforts"]
     if not segments:
@@ -525,50 +669,108 @@ async def actseg_callback(callback_query: types.CallbackQuery):
 
 
 @dp.callback_query_handler(text_contains="story")
+@expensive_job
 async def story_callback(callback_query: types.CallbackQuery):
     telegram_id, lang, user_name = unpack_message(callback_query)
     activity_id = callback_query.data.split("story")[1]
-    story = Stories(telegram_id, activity_id, lang)
-    story_filepath = story.create_story()
-    if not story_filepath:
+    caller = await AsyncAPICaller.create(telegram_id)
+    raw_data = await caller.raw_data(get_activity=activity_id)
+    if not raw_data:
         await bot.send_message(telegram_id, BOT_MESSAGES[lang].NO_STORY)
         return
-    story_file = types.InputFile(story_filepath)
-    await bot.send_document(telegram_id, story_file)
-    logger.debug(LogTemplates["bot"].STORY_SENT.format(telegram_id))
 
-    await asyncio.sleep(60)
-
-    try:
-        os.remove(story_filepath)
-        logger.debug(LogTemplates["bot"].STORY_DELETED.format(story_filepath))
-    except FileNotFoundError:
-        logger.error(LogTemplates["bot"].CANT_DELETE_STORY.format(story_filepath))
+    # The same story could be already sent or rendered by the events worker.
+    key = story_key(activity_id, lang, raw_data)
+    file_key = artifact_key(telegram_id, "story", key)
+    if await send_cached(telegram_id, file_key, bot.send_document):
+        logger.debug(LogTemplates["bot"].STORY_SENT.format(telegram_id))
+        return
+    story = await asyncio.to_thread(story_cache.get_image, key)
+    if not story:
+        try:
+            story = await render_service.run(
+                render_story, telegram_id, activity_id, lang, raw_data
+            )
+        except RenderBusy:
+            await bot.send_message(telegram_id, BOT_MESSAGES[lang].RENDER_BUSY)
+            return
+        if not story:
+            await bot.send_message(telegram_id, BOT_MESSAGES[lang].NO_STORY)
+            return
+        await asyncio.to_thread(story_cache.save_image, key, story)
+    story_file = types.InputFile(story, filename=f"{activity_id}_story.png")
+    sent = await bot.send_document(telegram_id, story_file)
+    await asyncio.to_thread(save_file_id, file_key, sent.document.file_id)
+    logger.debug(LogTemplates["bot"].STORY_SENT.format(telegram_id))
 
 
 @dp.callback_query_handler(text_contains="forecast_")
+@expensive_job
 async def forecast_callback(callback_query: types.CallbackQuery):
     telegram_id, lang, user_name = unpack_message(callback_query)
     forecast_type = callback_query.data.split("forecast_")[1]
+    # All the charts are rendered in one job and sent as a media group.
+    forecast_types = FORECAST_KEYS if forecast_type == "all" else [forecast_type]
+
+    today = datetime.now().date()
+    keys = [
+        artifact_key(telegram_id, "forecast", today.year, stat_type, today, lang)
+        for stat_type in forecast_types
+    ]
+    file_ids = [await asyncio.to_thread(get_file_id, key) for key in keys]
+    if all(file_ids):
+        await send_photos(telegram_id, file_ids)
+        logger.debug(LogTemplates["bot"].FORECAST_SENT.format(telegram_id))
+        return
 
-    forecast = YearForecast(telegram_id, lang)
-    forecast_filepath = forecast.create_forecast(forecast_type)
+    forecast = await get_forecast(telegram_id)
+    try:
+        forecast_images = await render_service.run(
+            render_forecasts, forecast, forecast_types, lang
+        )
+    except RenderBusy:
+        await bot.send_message(telegram_id, BOT_MESSAGES[lang].RENDER_BUSY)
+        return
 
-    if not forecast_filepath:
+    if not forecast_images or not all(forecast_images):
         await bot.send_message(telegram_id, BOT_MESSAGES[lang].NO_FORECAST)
         return
 
-    file = types.InputFile(forecast_filepath)
-    await bot.send_photo(telegram_id, file)
+    files = [
+        types.InputFile(image, filename=f"{stat_type}.png")
+        for image, stat_type in zip(forecast_images, forecast_types)
+    ]
+    sent = await send_photos(telegram_id, files)
+    for key, message in zip(keys, sent):
+        await asyncio.to_thread(save_file_id, key, message.photo[-1].file_id)
     logger.debug(LogTemplates["bot"].FORECAST_SENT.format(telegram_id))
 
-    await asyncio.sleep(60)
 
-    try:
-        os.remove(forecast_filepath)
-        logger.debug(LogTemplates["bot"].FORECAST_DELETED.format(forecast_filepath))
-    except FileNotFoundError:
-        logger.error(LogTemplates["bot"].CANT_DELETE_FORECAST.format(forecast_filepath))
+async def get_forecast(telegram_id: int) -> YearForecast:
+    """Returns the forecast of the user prepared today or prepares it
+    from the activities of the current year. The forecast is shared by
+    the requests, so it doesn't depend on the language."""
+    forecast = forecast_cache.get(telegram_id)
+    if forecast is None:
+        caller = await AsyncAPICaller.create(telegram_id)
+        after, before = forecast_period()
+        forecast = await YearForecast.from_stream(
+            telegram_id,
+            caller.iter_activities(after=after, before=before, prefetch=1),
+        )
+        forecast_cache.set(telegram_id, forecast)
+    return forecast
+
+
+async def send_photos(telegram_id: int, photos: list) -> list:
+    """Sends the photo or the media group of photos (files or file_id),
+    returns the list of the sent messages."""
+    if len(photos) == 1:
+        return [await bot.send_photo(telegram_id, photos[0])]
+    media = types.MediaGroup()
+    for photo in photos:
+        media.attach_photo(photo)
+    return await bot.send_media_group(telegram_id, media)
 
 
 @dp.callback_query_handler(text_contains="segment")
@@ -576,8 +778,8 @@ async def segment_callback(callback_query: types.CallbackQuery):
     telegram_id, lang, user_name = unpack_message(callback_query)
     segment_id = callback_query.data.split("segment")[1]
 
-    caller = APICaller(telegram_id)
-    raw_data = caller.raw_data(get_segment=segment_id)
+    caller = await AsyncAPICaller.create(telegram_id)
+    raw_data = await caller.raw_data(get_segment=segment_id)
 
     if raw_data:
         data = formatter.format_segment(raw_data, lang)
@@ -586,6 +788,16 @@ async def segment_callback(callback_query: types.CallbackQuery):
         await bot.send_message(telegram_id, BOT_MESSAGES[lang].NO_ACTIVITY)
 
 
+async def send_cached(telegram_id: int, key: str, send) -> bool:
+    """Sends the artifact with the send method by its Telegram file_id
+    if it was already sent, so it isn't generated and uploaded again."""
+    file_id = await asyncio.to_thread(get_file_id, key)
+    if not file_id:
+        return False
+    await send(telegram_id, file_id)
+    return True
+
+
 # Message and callbacks unpackers.
 
 
@@ -595,6 +807,7 @@ def unpack_message(message: dict) -> tuple:
     lang = message.from_user.language_code
     lang = lang if lang == "ru" else "en"
     user_name = message.from_user.first_name
+    remember_lang(telegram_id, lang)
     try:
         logger.debug(LogTemplates["bot"].LOG_MESSAGE.format(telegram_id, message.text))
     except AttributeError:
@@ -602,8 +815,74 @@ def unpack_message(message: dict) -> tuple:
     return telegram_id, lang, user_name
 
 
-if __name__ == "__main__":
+async def on_startup(dp: Dispatcher):
+    """Launches background tasks and the web server and sets the webhook
+    in the webhook mode."""
+    await start_server()
+    background_tasks.append(asyncio.create_task(refresh_tokens()))
+    background_tasks.append(asyncio.create_task(process_events()))
+    background_tasks.append(asyncio.create_task(purge_states()))
+    background_tasks.append(asyncio.create_task(purge_expired()))
+    background_tasks.append(asyncio.create_task(run_janitor()))
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            WEBHOOK_URL + WEBHOOK_PATH,
+            max_connections=UPDATES_CONCURRENCY,
+            secret_token=WEBHOOK_SECRET,
+        )
+        logger.info(LogTemplates["bot"].WEBHOOK_SET.format(WEBHOOK_URL + WEBHOOK_PATH))
+
+
+async def on_shutdown(dp: Dispatcher):
+    """Finishes the updates in process and releases shared resources before
+    the bot stops. The webhook isn't deleted, since other bot workers behind
+    the load balancer can still receive updates."""
+    await stop_server()
+    await concurrency.wait_idle(SHUTDOWN_TIMEOUT)
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    await close_async_session()
+    render_service.shutdown()
+
+
+@web.middleware
+async def check_secret_token(request: web.Request, handler):
+    """Rejects webhook requests, which weren't sent by Telegram."""
+    if (
+        WEBHOOK_SECRET
+        and request.path == WEBHOOK_PATH
+        and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET
+    ):
+        raise web.HTTPUnauthorized()
+    return await handler(request)
+
+
+def start_webhook():
+    """Receives updates on the aiohttp server in the same process."""
+    web_app = web.Application(middlewares=[check_secret_token])
+    webhook_executor = executor.set_webhook(
+        dp,
+        WEBHOOK_PATH,
+        on_startup=on_startup,
+        on_shutdown=on_shutdown,
+        web_app=web_app,
+    )
+    webhook_executor.run_app(
+        host="0.0.0.0",
+        port=WEBHOOK_PORT,
+        shutdown_timeout=SHUTDOWN_TIMEOUT,
+        loop=webhook_executor.loop,
+    )
+
+
+def main():
+    """Runs the bot, called from main.py."""
     startup()
-    server_process = Process(target=run_server)
-    server_process.start()
-    executor.start_polling(dp)
+    migrate()
+    if WEBHOOK_URL:
+        start_webhook()
+    else:
+        executor.start_polling(
+            dp, reset_webhook=True, on_startup=on_startup, on_shutdown=on_shutdown
+        )
@@ -0,0 +1,138 @@
+import json
+
+from collections import OrderedDict
+from datetime import datetime
+from fnmatch import fnmatchcase
+
+from decouple import config
+
+from log_handler import Logger, LogTemplates
+
+logger = Logger(__name__)
+
+# Time to live (seconds) of the cached responses for every endpoint.
+TTLS = {
+    "get_activity": 10 * 60,
+    "get_segment": 60 * 60,
+    "get_starred_segments": 10 * 60,
+    "get_gear": 24 * 60 * 60,
+    "get_stats": 10 * 60,
+    "get_streams": 60 * 60,
+}
+CACHE_MAX_SIZE = config("CACHE_MAX_SIZE", default=1000, cast=int)
+CACHE_URL = config("CACHE_URL", default=None)
+KEY_PREFIX = "stravagram"
+
+
+class MemoryBackend:
+    """In-process LRU storage with expiration of the entries."""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+
+    async def get(self, key: str) -> str | None:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if datetime.now().timestamp() > expires_at:
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return value
+
+    async def set(self, key: str, value: str, ttl: int) -> None:
+        self.entries[key] = (datetime.now().timestamp() + ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    async def delete_pattern(self, pattern: str) -> int:
+        keys = [key for key in self.entries if fnmatchcase(key, pattern)]
+        for key in keys:
+            del self.entries[key]
+        return len(keys)
+
+
+class RedisBackend:
+    """Redis storage, which can be shared by several bot replicas. Eviction
+    is handled by Redis itself (maxmemory-policy allkeys-lru). Requires
+    the optional redis package."""
+
+    def __init__(self, url: str):
+        import redis.asyncio as redis
+
+        self.client = redis.from_url(url)
+
+    async def get(self, key: str) -> str | None:
+        return await self.client.get(key)
+
+    async def set(self, key: str, value: str, ttl: int) -> None:
+        await self.client.set(key, value, ex=ttl)
+
+    async def delete_pattern(self, pattern: str) -> int:
+        keys = [key async for key in self.client.scan_iter(match=pattern)]
+        if keys:
+            await self.client.delete(*keys)
+        return len(keys)
+
+
+class ResponseCache:
+    """Cache of the API responses keyed by (telegram_id, endpoint, args).
+    Entries live for the TTL of the endpoint, the least recently used ones
+    are evicted when the cache is full. Values are stored as JSON, so every
+    reader gets its own copy of the data."""
+
+    def __init__(self, backend: MemoryBackend | RedisBackend):
+        self.backend = backend
+
+    @staticmethod
+    def key(telegram_id: int | str, endpoint: str, args: tuple) -> str:
+        return ":".join(map(str, (KEY_PREFIX, telegram_id, endpoint, *args)))
+
+    async def get(self, telegram_id: int, endpoint: str, args: tuple):
+        value = await self.backend.get(self.key(telegram_id, endpoint, args))
+        if value is not None:
+            logger.debug(LogTemplates[__name__].CACHE_HIT.format(endpoint, args))
+            return json.loads(value)
+
+    async def set(self, telegram_id: int, endpoint: str, args: tuple, data) -> None:
+        ttl = TTLS.get(endpoint)
+        if not ttl or data is None:
+            return
+        await self.backend.set(
+            self.key(telegram_id, endpoint, args), json.dumps(data), ttl
+        )
+
+    async def invalidate(self, endpoint: str, args: tuple) -> None:
+        """Deletes the entries of the endpoint with the args for all users."""
+        deleted = await self.backend.delete_pattern(self.key("*", endpoint, args))
+        logger.debug(
+            LogTemplates[__name__].INVALIDATED.format(deleted, endpoint, args)
+        )
+
+    async def invalidate_user(self, telegram_id: int) -> None:
+        """Deletes all the entries of the user, who was re-authorized."""
+        deleted = await self.backend.delete_pattern(self.key(telegram_id, "*", ()))
+        logger.debug(LogTemplates[__name__].INVALIDATED.format(deleted, "*", ()))
+
+    async def invalidate_event(self, event: dict) -> None:
+        """Deletes the entries, which became stale after the Strava webhook
+        event: the activity itself, its streams and the stats of its owner."""
+        if event.get("object_type") == "activity":
+            activity_id = event.get("object_id")
+            await self.invalidate("get_activity", (activity_id,))
+            await self.invalidate("get_streams", (activity_id,))
+        await self.invalidate("get_stats", (event.get("owner_id"),))
+
+
+def create_cache() -> ResponseCache:
+    """Creates the cache with Redis backend if CACHE_URL is set,
+    otherwise with in-process memory backend."""
+    if CACHE_URL:
+        return ResponseCache(RedisBackend(CACHE_URL))
+    return ResponseCache(MemoryBackend(CACHE_MAX_SIZE))
+
+
+response_cache = create_cache()
@@ -1,19 +1,43 @@
+import os
+
 from datetime import datetime
 
-from sqlalchemy import Column, Integer, String, create_engine
+from sqlalchemy import BigInteger, Column, Integer, String, create_engine, \
+    text
+from sqlalchemy.dialects.postgresql import JSONB, insert
 from sqlalchemy.orm import sessionmaker, declarative_base
 from decouple import config
 from log_handler import Logger, LogTemplates
+from templates_handler import Constants
 
 logger = Logger(__name__)
 Base = declarative_base()
 
+CONNECTION_CONFIG = {
+    'user': config('DBUSER'),
+    'password': config('PASSWORD'),
+    'host': config('HOST'),
+    'port': config('PORT'),
+    'database': config('DATABASE'),
+    'sslmode': 'require'}
+
+# One engine (and one connection pool) for the whole process.
+engine = create_engine(
+    'postgresql://', connect_args=CONNECTION_CONFIG,
+    pool_size=config('DB_POOL_SIZE', default=5, cast=int),
+    max_overflow=config('DB_MAX_OVERFLOW', default=10, cast=int),
+    pool_pre_ping=config('DB_POOL_PRE_PING', default=True, cast=bool),
+    pool_recycle=config('DB_POOL_RECYCLE', default=1800, cast=int))
+Session = sessionmaker(bind=engine)
+# Key of the advisory lock taken by migrate().
+MIGRATIONS_LOCK = 7342001
+
 
 class Users(Base):
     __tablename__ = 'users'
 
     id = Column(Integer, primary_key=True)
-    telegram_id = Column(Integer)
+    telegram_id = Column(Integer, index=True, unique=True)
     strava_id = Column(Integer)
     token_type = Column(String)
     access_token = Column(String)
@@ -25,18 +49,55 @@ class Users(Base):
             f"strava_id='{self.strava_id}')>"
 
 
+class Activities(Base):
+    """Summaries of the athletes' activities, as returned by the API."""
+    __tablename__ = 'activities'
+
+    strava_id = Column(BigInteger, primary_key=True)
+    activity_id = Column(BigInteger, primary_key=True)
+    start_date = Column(Integer, index=True)
+    summary = Column(JSONB)
+
+    def __repr__(self):
+        return f"<Activity(strava_id='{self.strava_id}', "\
+            f"activity_id='{self.activity_id}')>"
+
+
+class ActivitySync(Base):
+    """State of the activities sync for the athlete: the earliest synced
+    time, start time of the latest activity and time of the last sync."""
+    __tablename__ = 'activity_sync'
+
+    strava_id = Column(BigInteger, primary_key=True)
+    synced_from = Column(Integer)
+    last_start = Column(Integer)
+    synced_at = Column(Integer)
+
+
+class FsmStates(Base):
+    """aiogram FSM states and data of the users in the chats."""
+    __tablename__ = 'fsm_states'
+
+    chat_id = Column(BigInteger, primary_key=True)
+    user_id = Column(BigInteger, primary_key=True)
+    state = Column(String)
+    data = Column(String)
+    updated_at = Column(Integer, index=True)
+
+
+class FileIds(Base):
+    """Telegram file_id of the artifacts sent by the bot."""
+    __tablename__ = 'file_ids'
+
+    key = Column(String, primary_key=True)
+    file_id = Column(String)
+    created_at = Column(Integer)
+
+
 class DatabaseSession:
+    """Session for the user with the specified telegram_id, uses the shared
+    engine. Can be used as a context manager, which closes the session."""
     def __init__(self, telegram_id):
-        self.connection_config = {
-            'user': config('DBUSER'),
-            'password': config('PASSWORD'),
-            'host': config('HOST'),
-            'port': config('PORT'),
-            'database': config('DATABASE'),
-            'sslmode': 'require'}
-
-        self.engine = create_engine('postgresql://',
-                                    connect_args=self.connection_config)
         self.telegram_id = telegram_id
 
         self.connect()
@@ -46,15 +107,21 @@ class DatabaseSession:
         else:
             logger.error(LogTemplates[__name__].CANT_CONNECT)
 
-        self.user = None
-        if self.exists_in_database():
-            self.user = self.session.query(Users).filter(
-                Users.telegram_id == self.telegram_id).one()
-            self.strava_id = self.user.strava_id
+        self.user = self.session.query(Users).filter(
+            Users.telegram_id == self.telegram_id).one_or_none()
+        self.strava_id = self.user.strava_id if self.user else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type:
+            self.session.rollback()
+        self.disconnect()
 
     def connect(self):
+        self.session = None
         try:
-            Session = sessionmaker(bind=self.engine)
             self.session = Session()
         except Exception as error:
             logger.error(LogTemplates[__name__].CONNECTION_ERROR.format(
@@ -65,36 +132,83 @@ class DatabaseSession:
         logger.debug(LogTemplates[__name__].DISCONNECTED.format(
             self.telegram_id))
 
-    def exists_in_database(self):
-        return self.session.query(Users).filter(
-            Users.telegram_id == self.telegram_id).count() > 0
-
     def token_expired(self):
         now = datetime.now().timestamp()
         return now > self.user.expires_at - (60 * 60)
 
-    def get_token(self):
-        return self.user.refresh_token if self.token_expired() else \
-            self.user.access_token
-
     def get_users(self):
         return [user[0] for user in self.session.query(
             Users.strava_id).order_by(Users.id).all()]
 
     def add_user(self, auth_data):
-        if self.exists_in_database():
-            self.session.query(Users).filter(
-                Users.telegram_id == self.telegram_id).delete()
-            self.session.commit()
-            logger.info(LogTemplates[__name__].DELETED_FROM_DATABASE.format(
-                self.telegram_id))
-        new_user = Users(**auth_data)
-        self.session.add(new_user)
-        self.session.commit()
+        self.upsert_user(auth_data)
         logger.info(LogTemplates[__name__].ADDED_TO_DATABASE.format(
             self.telegram_id))
 
-    def update_user(self, auth_data):
-        self.session.query(Users).filter_by(
-            telegram_id=self.telegram_id).update(auth_data)
+    def refresh_user(self, auth_data, strava_id, refresh_token) -> bool:
+        """Writes the refreshed tokens only if the row still belongs to the
+        same Strava account and refresh token. Returns False if the user
+        was re-authorized or deleted since the tokens were read."""
+        updated = self.session.query(Users).filter(
+            Users.telegram_id == self.telegram_id,
+            Users.strava_id == strava_id,
+            Users.refresh_token == refresh_token).update(
+                {key: auth_data[key] for key in (
+                    'token_type', 'access_token', 'expires_at',
+                    'refresh_token')},
+                synchronize_session=False)
         self.session.commit()
+        return updated > 0
+
+    def delete_user(self):
+        self.session.query(Users).filter(
+            Users.telegram_id == self.telegram_id).delete()
+        self.session.commit()
+        logger.info(LogTemplates[__name__].DELETED_FROM_DATABASE.format(
+            self.telegram_id))
+
+    def upsert_user(self, auth_data):
+        """Inserts the user or updates the fields from auth_data
+        in a single INSERT ... ON CONFLICT statement."""
+        auth_data = {**auth_data, 'telegram_id': self.telegram_id}
+        statement = insert(Users).values(**auth_data)
+        statement = statement.on_conflict_do_update(
+            index_elements=[Users.telegram_id],
+            set_={key: statement.excluded[key] for key in auth_data
+                  if key != 'telegram_id'})
+        self.session.execute(statement)
+        self.session.commit()
+
+
+def get_telegram_id(strava_id: int) -> int | None:
+    """Returns the telegram_id of the athlete or None if the athlete
+    isn't a user of the bot."""
+    with Session() as session:
+        return session.query(Users.telegram_id).filter(
+            Users.strava_id == strava_id).limit(1).scalar()
+
+
+def migrate() -> None:
+    """Applies SQL files from the migrations directory, which weren't
+    applied yet. Applied migrations are stored in the migrations table.
+    Processes starting together are serialized with an advisory lock held
+    until the end of the transaction, so every file is applied once."""
+    with engine.begin() as connection:
+        connection.execute(text('SELECT pg_advisory_xact_lock(:key)'),
+                           {'key': MIGRATIONS_LOCK})
+        connection.execute(text(
+            'CREATE TABLE IF NOT EXISTS migrations '
+            '(name VARCHAR PRIMARY KEY)'))
+        applied = set(connection.execute(
+            text('SELECT name FROM migrations')).scalars())
+        for filename in sorted(os.listdir(Constants.MIGRATIONS_DIR.value)):
+            if not filename.endswith('.sql') or filename in applied:
+                continue
+            filepath = os.path.join(Constants.MIGRATIONS_DIR.value, filename)
+            with open(filepath, encoding='utf-8') as sql_file:
+                connection.exec_driver_sql(sql_file.read())
+            connection.execute(
+                text('INSERT INTO migrations (name) VALUES (:name)'),
+                {'name': filename})
+            logger.info(LogTemplates[__name__].MIGRATION_APPLIED.format(
+                filename))
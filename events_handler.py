@@ -0,0 +1,147 @@
+import asyncio
+
+import store_handler
+
+from analytics_handler import forecast_cache
+from api_handler import AsyncAPICaller
+from cache_handler import response_cache
+from database_handler import DatabaseSession, get_telegram_id
+from file_id_handler import artifact_key, delete_file_ids
+from image_handler import story_key
+from log_handler import Logger, LogTemplates
+from queue_handler import event_queue
+from ratelimit_handler import BACKGROUND
+from render_handler import RenderBusy, render_service, render_story
+from story_cache_handler import story_cache
+from token_handler import token_cache
+
+logger = Logger(__name__)
+
+EVENTS_BATCH = 10
+# Keys of the detailed activity, which aren't needed in the activity store.
+DETAIL_KEYS = (
+    "segment_efforts",
+    "splits_metric",
+    "splits_standard",
+    "laps",
+    "best_efforts",
+)
+# Languages of the users seen by the bot, used to pre-render the stories.
+user_langs = {}
+
+
+def remember_lang(telegram_id: int, lang: str) -> None:
+    user_langs[telegram_id] = lang
+
+
+async def warm_activity(telegram_id: int, activity_id: int) -> None:
+    """Prefetches the activity detail and streams and saves the summary to the
+    store, so they are ready before the user asks. Pre-renders the story if
+    the language of the user is known, the story with the same content
+    wasn't rendered yet and the renderers aren't busy."""
+    caller = await AsyncAPICaller.create(telegram_id, BACKGROUND)
+    raw_data, _ = await asyncio.gather(
+        caller.raw_data(get_activity=activity_id), caller.get_streams(activity_id)
+    )
+    if not raw_data:
+        return
+    summary = {key: value for key, value in raw_data.items() if key not in DETAIL_KEYS}
+    await asyncio.to_thread(store_handler.save_activities, caller.strava_id, [summary])
+    lang = user_langs.get(telegram_id)
+    if not lang:
+        return
+    key = story_key(activity_id, lang, raw_data)
+    if story_cache.exists(key):
+        return
+    try:
+        story = await render_service.run(
+            render_story, telegram_id, activity_id, lang, raw_data
+        )
+    except RenderBusy:
+        return
+    if not story:
+        return
+    await asyncio.to_thread(story_cache.save_image, key, story)
+
+
+async def forget_cached(telegram_id: int) -> None:
+    """Drops the cached token, responses, forecast and sent files of the
+    user, which belong to the Strava account the user had before."""
+    token_cache.invalidate(telegram_id)
+    await response_cache.invalidate_user(telegram_id)
+    forecast_cache.invalidate(telegram_id)
+    await asyncio.to_thread(delete_file_ids, artifact_key(telegram_id, ""))
+
+
+async def deauthorize(telegram_id: int, strava_id: int) -> None:
+    """Forgets the athlete, who revoked access to the application."""
+
+    def delete_user():
+        with DatabaseSession(telegram_id) as session:
+            session.delete_user()
+
+    await asyncio.to_thread(delete_user)
+    await asyncio.to_thread(store_handler.delete_athlete, strava_id)
+    await forget_cached(telegram_id)
+
+
+async def handle_event(event: dict) -> None:
+    """Invalidates the data, which became stale after the event, and warms
+    the cache with the fresh one."""
+    await response_cache.invalidate_event(event)
+    strava_id = event.get("owner_id")
+    telegram_id = await asyncio.to_thread(get_telegram_id, strava_id)
+    if not telegram_id:
+        return
+    object_type = event.get("object_type")
+    aspect_type = event.get("aspect_type")
+    if object_type == "activity":
+        activity_id = event.get("object_id")
+        # Sent GPX and forecasts don't match the activities anymore.
+        await asyncio.to_thread(
+            delete_file_ids, artifact_key(telegram_id, "activity", activity_id, "")
+        )
+        await asyncio.to_thread(
+            delete_file_ids, artifact_key(telegram_id, "forecast", "")
+        )
+        forecast_cache.invalidate(telegram_id)
+        if aspect_type == "delete":
+            await asyncio.to_thread(
+                store_handler.delete_activity, strava_id, activity_id
+            )
+        else:
+            await warm_activity(telegram_id, activity_id)
+    elif object_type == "athlete":
+        if event.get("updates", {}).get("authorized") == "false":
+            await deauthorize(telegram_id, strava_id)
+
+
+async def process_events(interval: int = 1) -> None:
+    """Background task, which takes the Strava webhook events from the durable
+    queue filled by the web server. Events are acknowledged after they are
+    handled, failed ones are retried later. The task keeps running if the
+    queue is unavailable, events taken, but not acknowledged, are taken
+    again after their lease expires."""
+    while True:
+        try:
+            events = await asyncio.to_thread(event_queue.take, EVENTS_BATCH)
+            for event_id, event in events:
+                await process_event(event_id, event)
+        except Exception as error:
+            logger.error(LogTemplates[__name__].QUEUE_ERROR.format(error))
+            events = None
+        if not events:
+            await asyncio.sleep(interval)
+
+
+async def process_event(event_id: int, event: dict) -> None:
+    """Handles the event taken from the queue and acknowledges it, or puts it
+    back to be retried later if it failed."""
+    try:
+        await handle_event(event)
+    except Exception as error:
+        logger.warning(LogTemplates[__name__].EVENT_FAILED.format(event_id, error))
+        await asyncio.to_thread(event_queue.retry, event_id)
+        return
+    await asyncio.to_thread(event_queue.ack, event_id)
+    logger.debug(LogTemplates[__name__].EVENT_HANDLED.format(event_id))
@@ -0,0 +1,83 @@
+import asyncio
+
+from datetime import datetime
+
+from decouple import config
+from sqlalchemy.dialects.postgresql import insert
+
+from database_handler import Session, FileIds
+from log_handler import Logger, LogTemplates
+
+logger = Logger(__name__)
+
+# file_id of the artifacts are kept for this time after they were sent,
+# the keys of the forecasts contain the day, so they are used only that day.
+FILE_ID_TTL = config("FILE_ID_TTL", default=30 * 24 * 60 * 60, cast=int)
+PURGE_INTERVAL = 60 * 60
+
+
+def artifact_key(telegram_id: int, *parts) -> str:
+    """Returns the key of the artifact sent to the user, for example
+    <telegram_id>:activity:<activity_id>:gpx. Keys start with the user,
+    so the file is never sent to another user."""
+    return ":".join(map(str, (telegram_id, *parts)))
+
+
+def get_file_id(key: str) -> str | None:
+    """Returns the Telegram file_id of the artifact or None if it wasn't sent."""
+    with Session() as session:
+        file_id = session.query(FileIds.file_id).filter_by(key=key).scalar()
+    if file_id:
+        logger.debug(LogTemplates[__name__].FILE_ID_HIT.format(key))
+    return file_id
+
+
+def save_file_id(key: str, file_id: str) -> None:
+    """Upserts the Telegram file_id of the artifact."""
+    values = {"file_id": file_id, "created_at": int(datetime.now().timestamp())}
+    with Session() as session:
+        statement = insert(FileIds).values(key=key, **values)
+        statement = statement.on_conflict_do_update(
+            index_elements=[FileIds.key], set_=values
+        )
+        session.execute(statement)
+        session.commit()
+
+
+def delete_file_ids(prefix: str) -> None:
+    """Deletes the file_id of the artifacts with the key prefix,
+    which became stale."""
+    with Session() as session:
+        deleted = (
+            session.query(FileIds)
+            .filter(FileIds.key.startswith(prefix, autoescape=True))
+            .delete(synchronize_session=False)
+        )
+        session.commit()
+    logger.debug(LogTemplates[__name__].FILE_IDS_DELETED.format(deleted, prefix))
+
+
+def purge_file_ids(ttl: int = FILE_ID_TTL) -> int:
+    """Deletes the file_id sent more than ttl ago, returns the number of them."""
+    expired_at = int(datetime.now().timestamp()) - ttl
+    with Session() as session:
+        deleted = (
+            session.query(FileIds)
+            .filter(FileIds.created_at < expired_at)
+            .delete(synchronize_session=False)
+        )
+        session.commit()
+    return deleted
+
+
+async def purge_expired(interval: int = PURGE_INTERVAL) -> None:
+    """Background task, which deletes the expired file_id."""
+    while True:
+        try:
+            deleted = await asyncio.to_thread(purge_file_ids)
+        except Exception as error:
+            logger.error(LogTemplates[__name__].PURGE_FAILED.format(error))
+        else:
+            if deleted:
+                logger.debug(LogTemplates[__name__].FILE_IDS_PURGED.format(deleted))
+        await asyncio.sleep(interval)
@@ -0,0 +1,161 @@
+import asyncio
+import copy
+import json
+import os
+import typing
+
+from datetime import datetime
+
+from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from aiogram.dispatcher.storage import BaseStorage
+from decouple import config
+from sqlalchemy import create_engine
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import sessionmaker
+
+from database_handler import FsmStates, engine
+from templates_handler import Constants
+from log_handler import Logger, LogTemplates
+
+logger = Logger(__name__)
+
+# postgres - shared by all the bot processes, file - local SQLite file for a
+# single node, memory - states are lost on restart.
+FSM_STORAGE = config("FSM_STORAGE", default="postgres")
+# States, which weren't updated for this time, are considered abandoned.
+FSM_STATE_TTL = config("FSM_STATE_TTL", default=24 * 60 * 60, cast=int)
+PURGE_INTERVAL = 60 * 60
+
+Address = typing.Union[str, int, None]
+
+
+class SQLStorage(BaseStorage):
+    """aiogram FSM storage in the fsm_states table, so states survive
+    restarts and the updates of a user can be handled by any bot process.
+    States expire after ttl seconds without updates. Queries are blocking,
+    so they run in threads."""
+
+    def __init__(self, engine: Engine, ttl: int):
+        self.session = sessionmaker(bind=engine)
+        self.ttl = ttl
+
+    def is_expired(self, row: FsmStates) -> bool:
+        return row.updated_at < datetime.now().timestamp() - self.ttl
+
+    def read(self, chat: int, user: int) -> tuple:
+        """Returns the state and the data of the user in the chat."""
+        with self.session() as session:
+            row = session.get(FsmStates, (chat, user))
+            if row is None or self.is_expired(row):
+                return None, {}
+            return row.state, json.loads(row.data)
+
+    def write(self, chat: int, user: int, change: typing.Callable) -> None:
+        """Applies the change to the record of the user in the chat.
+        The row is locked, so concurrent changes aren't lost."""
+        with self.session() as session:
+            row = session.get(FsmStates, (chat, user), with_for_update=True)
+            if row is None or self.is_expired(row):
+                record = {"state": None, "data": {}}
+            else:
+                record = {"state": row.state, "data": json.loads(row.data)}
+            change(record)
+            if record["state"] is None and not record["data"]:
+                if row is not None:
+                    session.delete(row)
+            else:
+                if row is None:
+                    row = FsmStates(chat_id=chat, user_id=user)
+                    session.add(row)
+                row.state = record["state"]
+                row.data = json.dumps(record["data"])
+                row.updated_at = int(datetime.now().timestamp())
+            session.commit()
+
+    def purge(self) -> int:
+        """Deletes the expired states, returns the number of them."""
+        expired_at = int(datetime.now().timestamp()) - self.ttl
+        with self.session() as session:
+            deleted = (
+                session.query(FsmStates)
+                .filter(FsmStates.updated_at < expired_at)
+                .delete(synchronize_session=False)
+            )
+            session.commit()
+        return deleted
+
+    async def close(self):
+        pass
+
+    async def wait_closed(self):
+        pass
+
+    def resolve_address(self, chat: Address, user: Address) -> tuple:
+        return tuple(map(int, self.check_address(chat=chat, user=user)))
+
+    async def get_state(
+        self, *, chat: Address = None, user: Address = None, default: str = None
+    ) -> str | None:
+        state, _ = await asyncio.to_thread(self.read, *self.resolve_address(chat, user))
+        return state if state is not None else self.resolve_state(default)
+
+    async def get_data(
+        self, *, chat: Address = None, user: Address = None, default: dict = None
+    ) -> dict:
+        _, data = await asyncio.to_thread(self.read, *self.resolve_address(chat, user))
+        return data or copy.deepcopy(default or {})
+
+    async def set_state(
+        self, *, chat: Address = None, user: Address = None, state=None
+    ) -> None:
+        def change(record):
+            record["state"] = self.resolve_state(state)
+
+        await asyncio.to_thread(self.write, *self.resolve_address(chat, user), change)
+
+    async def set_data(
+        self, *, chat: Address = None, user: Address = None, data: dict = None
+    ) -> None:
+        def change(record):
+            record["data"] = copy.deepcopy(data or {})
+
+        await asyncio.to_thread(self.write, *self.resolve_address(chat, user), change)
+
+    async def update_data(
+        self, *, chat: Address = None, user: Address = None, data: dict = None, **kwargs
+    ) -> None:
+        def change(record):
+            record["data"].update(data or {}, **kwargs)
+
+        await asyncio.to_thread(self.write, *self.resolve_address(chat, user), change)
+
+
+def create_storage() -> BaseStorage:
+    """Creates the FSM storage chosen with FSM_STORAGE."""
+    if FSM_STORAGE == "memory":
+        return MemoryStorage()
+    if FSM_STORAGE == "file":
+        os.makedirs(os.path.dirname(Constants.FSM_PATH.value), exist_ok=True)
+        file_engine = create_engine(f"sqlite:///{Constants.FSM_PATH.value}")
+        FsmStates.__table__.create(file_engine, checkfirst=True)
+        return SQLStorage(file_engine, FSM_STATE_TTL)
+    # The table is created by the migrations.
+    return SQLStorage(engine, FSM_STATE_TTL)
+
+
+async def purge_states(interval: int = PURGE_INTERVAL) -> None:
+    """Background task, which deletes the abandoned states."""
+    if not isinstance(storage, SQLStorage):
+        return
+    while True:
+        try:
+            deleted = await asyncio.to_thread(storage.purge)
+        except Exception as error:
+            logger.error(LogTemplates[__name__].PURGE_FAILED.format(error))
+        else:
+            if deleted:
+                logger.debug(LogTemplates[__name__].STATES_PURGED.format(deleted))
+        await asyncio.sleep(interval)
+
+
+storage = create_storage()
@@ -0,0 +1,111 @@
+import asyncio
+import os
+
+from copy import deepcopy
+
+import aiohttp
+import requests
+
+from decouple import config
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from log_handler import Logger, LogTemplates
+
+logger = Logger(__name__)
+
+POOL_CONNECTIONS = config("HTTP_POOL_CONNECTIONS", default=4, cast=int)
+POOL_SIZE = config("HTTP_POOL_SIZE", default=20, cast=int)
+CONNECT_TIMEOUT = config("HTTP_CONNECT_TIMEOUT", default=5, cast=float)
+READ_TIMEOUT = config("HTTP_READ_TIMEOUT", default=30, cast=float)
+RETRIES = config("HTTP_RETRIES", default=2, cast=int)
+
+
+class PooledSession(requests.Session):
+    """Keep-alive session with connection pooling, retries on idempotent
+    requests and default timeouts for every request."""
+
+    def __init__(self):
+        super().__init__()
+        retries = Retry(
+            total=RETRIES,
+            backoff_factor=0.3,
+            status_forcelist=(502, 503, 504),
+        )
+        adapter = HTTPAdapter(
+            pool_connections=POOL_CONNECTIONS,
+            pool_maxsize=POOL_SIZE,
+            max_retries=retries,
+        )
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+        self.timeout = (CONNECT_TIMEOUT, READ_TIMEOUT)
+
+    def request(self, *args, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return super().request(*args, **kwargs)
+
+
+_session = None
+_session_pid = None
+
+
+def get_session() -> requests.Session:
+    """Returns the process-wide HTTP session. The session is created lazily
+    and recreated after fork, so child processes never share sockets."""
+    global _session, _session_pid
+    if _session is None or _session_pid != os.getpid():
+        _session = PooledSession()
+        _session_pid = os.getpid()
+        logger.debug(
+            LogTemplates[__name__].SESSION_CREATED.format(POOL_SIZE, _session_pid)
+        )
+    return _session
+
+
+_async_session = None
+
+
+def get_async_session() -> aiohttp.ClientSession:
+    """Returns the process-wide asynchronous HTTP session. Must be called from
+    the running event loop, the session is bound to it."""
+    global _async_session
+    if _async_session is None or _async_session.closed:
+        connector = aiohttp.TCPConnector(limit=POOL_SIZE, keepalive_timeout=60)
+        timeout = aiohttp.ClientTimeout(
+            sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT
+        )
+        _async_session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        logger.debug(LogTemplates[__name__].ASYNC_SESSION_CREATED.format(POOL_SIZE))
+    return _async_session
+
+
+async def close_async_session() -> None:
+    """Closes the asynchronous HTTP session, used on shutdown."""
+    if _async_session is not None and not _async_session.closed:
+        await _async_session.close()
+        logger.debug(LogTemplates[__name__].ASYNC_SESSION_CLOSED)
+
+
+class SingleFlight:
+    """Coalesces identical concurrent calls. While the call with the key is in
+    flight, other callers with the same key wait for its result instead of
+    making the same call again. Every caller gets its own copy of the result,
+    because the formatters modify the data in place."""
+
+    def __init__(self):
+        self.calls = {}
+
+    async def do(self, key: tuple, function, *args, **kwargs):
+        call = self.calls.get(key)
+        if call is None:
+            call = asyncio.ensure_future(function(*args, **kwargs))
+            self.calls[key] = call
+            call.add_done_callback(lambda _: self.calls.pop(key, None))
+        else:
+            logger.debug(LogTemplates[__name__].CALL_COALESCED.format(key))
+        # Shielded, so the cancelled caller doesn't cancel the call for others.
+        return deepcopy(await asyncio.shield(call))
+
+
+single_flight = SingleFlight()
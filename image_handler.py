@@ -1,15 +1,17 @@
-import requests
+import hashlib
+import json
 import os
 
 from datetime import timedelta, datetime
 from enum import Enum
+from io import BytesIO
+from math import cos, radians
 
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageDraw
 from polyline import decode
 
-import matplotlib.pyplot as plt
-
-from api_handler import APICaller
+from assets_handler import assets
+from http_handler import get_session
 from templates_handler import Constants
 from log_handler import Logger, LogTemplates
 
@@ -18,16 +20,16 @@ logger = Logger(__name__)
 
 
 class ImageProperties(Enum):
-    NAME_FONT = ImageFont.truetype(
-        os.path.join(Constants.FONTS_DIR.value, "lsr.ttf"), 50
-    )
-    DATE_FONT = ImageFont.truetype(
-        os.path.join(Constants.FONTS_DIR.value, "lsb.ttf"), 30
-    )
-    STATS_FONT = ImageFont.truetype(
-        os.path.join(Constants.FONTS_DIR.value, "lsr.ttf"), 70
-    )
+    NAME_FONT = assets.font("lsr.ttf", 50)
+    DATE_FONT = assets.font("lsb.ttf", 30)
+    STATS_FONT = assets.font("lsr.ttf", 70)
     FONT_COLOR = (255, 255, 255)
+    # The box for the route on the story template.
+    ROUTE_BOX = (156, 1510, 924, 1820)
+    ROUTE_WIDTH = 3
+    # The route is drawn on the canvas this times bigger and downsampled,
+    # which smooths the edges of the line.
+    ROUTE_SUPERSAMPLING = 4
 
 
 LOCALE = {
@@ -44,23 +46,99 @@ LOCALE = {
 }
 
 
+def draw_route(points: list, size: tuple, width: int) -> Image.Image:
+    """Projects the route points onto the transparent canvas of the size,
+    keeping the proportions of the route and centering it."""
+    factor = ImageProperties.ROUTE_SUPERSAMPLING.value
+    canvas_width, canvas_height = size[0] * factor, size[1] * factor
+    # Equirectangular projection, longitudes are shrinked to the latitude.
+    shrink = cos(radians(sum(point[0] for point in points) / len(points)))
+    xs = [point[1] * shrink for point in points]
+    ys = [-point[0] for point in points]
+    min_x, min_y = min(xs), min(ys)
+    route_width, route_height = max(xs) - min_x, max(ys) - min_y
+    margin = width * factor
+    scale = min(
+        (canvas_width - 2 * margin) / (route_width or 1),
+        (canvas_height - 2 * margin) / (route_height or 1),
+    )
+    logger.debug(LogTemplates[__name__].CALCULATED_SCALE.format(scale))
+    x_offset = (canvas_width - route_width * scale) / 2
+    y_offset = (canvas_height - route_height * scale) / 2
+    route = Image.new("RGBA", (canvas_width, canvas_height), (0, 0, 0, 0))
+    ImageDraw.Draw(route).line(
+        [
+            ((x - min_x) * scale + x_offset, (y - min_y) * scale + y_offset)
+            for x, y in zip(xs, ys)
+        ],
+        fill=ImageProperties.FONT_COLOR.value,
+        width=width * factor,
+        joint="curve",
+    )
+    return route.resize(size, Image.LANCZOS)
+
+
+def story_template(raw_data: dict) -> str:
+    """Returns the path to the story template for the activity depending
+    on the optional fields."""
+    heartrate = raw_data.get("has_heartrate")
+    achievements = raw_data.get("achievement_count")
+    if heartrate and achievements:
+        template = "stories_hr_ac.png"
+    elif heartrate:
+        template = "stories_hr.png"
+    elif achievements:
+        template = "stories_ac.png"
+    else:
+        template = "stories.png"
+    return os.path.join(Constants.STORIES_TEMPLATES.value, template)
+
+
+def story_key(activity_id: int, lang: str, raw_data: dict) -> str:
+    """Returns the key of the story, which changes whenever anything drawn
+    on it changes: the fields used, the template or the locale."""
+    photos = raw_data.get("photos") or {}
+    fields = {
+        key: raw_data.get(key)
+        for key in (
+            "name",
+            "start_date_local",
+            "distance",
+            "moving_time",
+            "total_elevation_gain",
+            "type",
+            "average_speed",
+            "has_heartrate",
+            "average_heartrate",
+            "achievement_count",
+        )
+    }
+    fields["polyline"] = (raw_data.get("map") or {}).get("polyline")
+    fields["photo"] = ((photos.get("primary") or {}).get("urls") or {}).get("600")
+    fields["template"] = os.path.basename(story_template(raw_data))
+    digest = hashlib.sha256(json.dumps(fields, sort_keys=True).encode()).hexdigest()
+    return f"{activity_id}_{lang}_{digest[:16]}"
+
+
 class Stories:
     """Class for creating Instagram stories image from Strava activities.
     Args:
         telegram_id (int): user's telegram id
         activity_id (int): the id of the activity to be processed
         lang (str): user's language code
+        raw_data (dict): activity data from the API
     """
 
-    def __init__(self, telegram_id: int, activity_id: int, lang: str):
+    def __init__(
+        self, telegram_id: int, activity_id: int, lang: str, raw_data: dict
+    ):
         self.telegram_id = telegram_id
         self.activity_id = activity_id
         self.lang = lang
-        self.image_filepath = None
-        self.route_filepath = None
+        self.image = None
+        self.route_image = None
 
-        caller = APICaller(telegram_id)
-        self.raw_data = caller.raw_data(get_activity=activity_id)
+        self.raw_data = raw_data
 
         self.create_images()
         self.prepare_stats()
@@ -68,7 +146,7 @@ class Stories:
         self.add_stats()
 
     def create_images(self):
-        """Downloads activity image and route polyline and saves them to the files."""
+        """Downloads activity image to memory and draws the route polyline."""
         image_url = None
         try:
             image_url = self.raw_data["photos"]["primary"]["urls"]["600"]
@@ -78,13 +156,10 @@ class Stories:
             )
             pass
         if image_url:
-            self.image_filepath = os.path.join(
-                Constants.IMAGE_PATH.value, f"{self.activity_id}_photo.png"
-            )
-            with open(self.image_filepath, "wb") as f:
-                f.write(requests.get(image_url).content)
-            logger.debug(LogTemplates[__name__].SAVED_IMAGE.format(self.image_filepath))
+            self.image = BytesIO(get_session().get(image_url).content)
+            logger.debug(LogTemplates[__name__].SAVED_IMAGE.format(self.activity_id))
 
+        polyline = None
         try:
             polyline = self.raw_data["map"]["polyline"]
         except KeyError:
@@ -93,18 +168,11 @@ class Stories:
             )
             pass
         if polyline:
-            points = decode(polyline)
-            latitudes = [point[0] for point in points]
-            longitudes = [point[1] for point in points]
-            fig, ax = plt.subplots()
-            ax.plot(longitudes, latitudes, color="white", linewidth=2)
-            fig.patch.set_alpha(0.0)
-            ax.set_axis_off()
-            self.route_filepath = os.path.join(
-                Constants.IMAGE_PATH.value, f"{self.activity_id}_route.png"
+            x1, y1, x2, y2 = ImageProperties.ROUTE_BOX.value
+            self.route_image = draw_route(
+                decode(polyline), (x2 - x1, y2 - y1), ImageProperties.ROUTE_WIDTH.value
             )
-            plt.savefig(self.route_filepath, transparent=True)
-            logger.debug(LogTemplates[__name__].SAVED_ROUTE.format(self.route_filepath))
+            logger.debug(LogTemplates[__name__].ROUTE_DRAWN.format(self.activity_id))
 
     def prepare_stats(self):
         """Extracts and prepares activity stats for the image."""
@@ -154,27 +222,12 @@ class Stories:
 
     def select_template(self):
         """Selects template for the image depending on the activity type and optional fields."""
-        if self.heartrate and self.achievements:
-            self.template = os.path.join(
-                Constants.STORIES_TEMPLATES.value, "stories_hr_ac.png"
-            )
-        elif self.heartrate:
-            self.template = os.path.join(
-                Constants.STORIES_TEMPLATES.value, "stories_hr.png"
-            )
-        elif self.achievements:
-            self.template = os.path.join(
-                Constants.STORIES_TEMPLATES.value, "stories_ac.png"
-            )
-        else:
-            self.template = os.path.join(
-                Constants.STORIES_TEMPLATES.value, "stories.png"
-            )
+        self.template = story_template(self.raw_data)
         logger.debug(LogTemplates[__name__].TEMPLATE_SELECTED.format(self.template))
 
     def add_stats(self):
         """Adds stats to the template."""
-        self.story_image = Image.open(self.template)
+        self.story_image = assets.image(self.template)
         draw = ImageDraw.Draw(self.story_image)
 
         draw.text(
@@ -241,17 +294,17 @@ class Stories:
             )
         logger.debug(LogTemplates[__name__].STATS_ADDED.format(self.activity_id))
 
-    def create_story(self) -> str:
+    def create_story(self) -> BytesIO:
         """Prepares and inserts activity image and route map into the template.
 
         Returns:
-            str: returns the path to the created story image
+            BytesIO: returns the buffer with the created story image (PNG)
         """
-        if not self.image_filepath or not self.route_filepath:
+        if not self.image or not self.route_image:
             return
 
         try:
-            image = Image.open(self.image_filepath)
+            image = Image.open(self.image)
 
             (x1, y1, x2, y2) = (156, 672, 924, 1248)
 
@@ -277,42 +330,12 @@ class Stories:
         except Exception as error:
             logger.error(LogTemplates[__name__].CANT_ADD_IMAGE.format(error))
 
-        route = Image.open(self.route_filepath).convert("RGBA")
-        width, height = route.size
-        scale = round(min((768 / width), (310 / height)), 2)
-        logger.debug(LogTemplates[__name__].CALCULATED_SCALE.format(scale))
-
-        width = int(width * scale)
-        height = int(height * scale)
-        route = route.resize((width, height))
-        logger.debug(LogTemplates[__name__].RESIZED_ROUTE.format(width, height))
-
-        x_offset = int((768 - width) / 2)
-        y_offset = int((310 - height) / 2)
-
         self.story_image.paste(
-            route,
-            (
-                156 + x_offset,
-                1510 + y_offset,
-                156 + x_offset + width,
-                1510 + y_offset + height,
-            ),
-            mask=route,
+            self.route_image, ImageProperties.ROUTE_BOX.value, mask=self.route_image
         )
 
-        story_filepath = os.path.join(
-            Constants.IMAGE_PATH.value, f"{self.activity_id}_story.png"
-        )
-
-        self.story_image.save(story_filepath)
-        logger.info(LogTemplates[__name__].STORY_CREATED.format(story_filepath))
-
-        try:
-            os.remove(self.image_filepath)
-            os.remove(self.route_filepath)
-        except FileNotFoundError as error:
-            logger.error(LogTemplates[__name__].CANT_REMOVE_FILES.format(error))
-            pass
-
-        return story_filepath
+        story = BytesIO()
+        self.story_image.save(story, "PNG")
+        story.seek(0)
+        logger.info(LogTemplates[__name__].STORY_CREATED.format(self.activity_id))
+        return story
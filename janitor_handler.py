@@ -0,0 +1,144 @@
+import asyncio
+import heapq
+import os
+import threading
+
+from datetime import datetime
+
+from decouple import config
+
+from templates_handler import Constants
+from log_handler import Logger, LogTemplates
+
+logger = Logger(__name__)
+
+# Rendered stories, which weren't used for this time, are deleted.
+ARTIFACT_TTL = config("ARTIFACT_TTL", default=7 * 24 * 60 * 60, cast=int)
+# Maximum size of the artifacts on disk, the ones expiring first are
+# deleted when it's exceeded.
+ARTIFACTS_MAX_MB = config("ARTIFACTS_MAX_MB", default=500, cast=int)
+JANITOR_BATCH = config("JANITOR_BATCH", default=200, cast=int)
+JANITOR_INTERVAL = config("JANITOR_INTERVAL", default=60, cast=int)
+
+# Directories of the artifacts, which are tracked.
+ARTIFACTS_DIRS = [Constants.STORIES_CACHE.value]
+# Directories, where the files were written by the older versions and
+# nothing is written anymore, so all the files there are orphans.
+ORPHANS_DIRS = [
+    Constants.IMAGE_PATH.value,
+    os.path.join(Constants.ABSOLUTE_PATH.value, "gpx"),
+]
+
+
+class Janitor:
+    """Deletes the artifacts written to disk when they expire, in batches by
+    a single background task. Artifacts are tracked with their expiry time
+    and size, so the total size is kept under the limit too."""
+
+    def __init__(self, ttl: int, max_bytes: int, batch: int):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.batch = batch
+        # Path: (expires_at, size). The heap may keep outdated entries of
+        # the artifacts tracked again, they are skipped.
+        self.artifacts = {}
+        self.heap = []
+        self.used = 0
+        self.lock = threading.Lock()
+
+    def track(self, path: str, expires_at: float = None) -> None:
+        """Tracks the artifact or extends the expiry of the tracked one."""
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return
+        expires_at = expires_at or datetime.now().timestamp() + self.ttl
+        with self.lock:
+            _, old_size = self.artifacts.get(path, (None, 0))
+            self.artifacts[path] = (expires_at, size)
+            self.used += size - old_size
+            heapq.heappush(self.heap, (expires_at, path))
+
+    def pop_due(self, now: float) -> str | None:
+        """Returns the path of the expired artifact or the one expiring first
+        if the size limit is exceeded, None if nothing should be deleted."""
+        with self.lock:
+            while self.heap:
+                expires_at, path = self.heap[0]
+                if self.artifacts.get(path, (None,))[0] != expires_at:
+                    heapq.heappop(self.heap)
+                    continue
+                if expires_at > now and self.used <= self.max_bytes:
+                    return None
+                heapq.heappop(self.heap)
+                _, size = self.artifacts.pop(path)
+                self.used -= size
+                return path
+        return None
+
+    def clean(self) -> int:
+        """Deletes up to a batch of the artifacts, returns the number of them."""
+        now = datetime.now().timestamp()
+        deleted = 0
+        while deleted < self.batch:
+            path = self.pop_due(now)
+            if path is None:
+                break
+            remove_file(path)
+            deleted += 1
+        return deleted
+
+    def sweep(self) -> None:
+        """Deletes the files left by a crash or an older version and tracks
+        the artifacts left from the previous run, which expire ttl after
+        they were written."""
+        orphans = 0
+        for directory in ORPHANS_DIRS:
+            for entry in scan_files(directory):
+                orphans += remove_file(entry.path)
+        for directory in ARTIFACTS_DIRS:
+            for entry in scan_files(directory):
+                if entry.name.endswith(".tmp"):
+                    orphans += remove_file(entry.path)
+                else:
+                    self.track(entry.path, entry.stat().st_mtime + self.ttl)
+        deleted = 0
+        while cleaned := self.clean():
+            deleted += cleaned
+        logger.info(
+            LogTemplates[__name__].SWEPT.format(
+                orphans, deleted, len(self.artifacts), self.used
+            )
+        )
+
+
+def scan_files(directory: str) -> list:
+    try:
+        return [entry for entry in os.scandir(directory) if entry.is_file()]
+    except FileNotFoundError:
+        return []
+
+
+def remove_file(path: str) -> bool:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        return False
+    except OSError as error:
+        logger.warning(LogTemplates[__name__].CANT_DELETE.format(path, error))
+        return False
+    return True
+
+
+async def run_janitor(interval: int = JANITOR_INTERVAL) -> None:
+    """Background task, which deletes the expired artifacts."""
+    while True:
+        deleted = await asyncio.to_thread(janitor.clean)
+        if deleted:
+            logger.debug(LogTemplates[__name__].CLEANED.format(deleted, janitor.used))
+        # The next batch right away if there is more to delete.
+        if deleted < janitor.batch:
+            await asyncio.sleep(interval)
+
+
+janitor = Janitor(ARTIFACT_TTL, ARTIFACTS_MAX_MB * 1024 * 1024, JANITOR_BATCH)
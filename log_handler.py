@@ -19,9 +19,10 @@ class DatabaseHandlerModel(BaseModel):
     DISCONNECTED: str
     DELETED_FROM_DATABASE: str
     ADDED_TO_DATABASE: str
+    MIGRATION_APPLIED: str
 
 
-class FlaskServerModel(BaseModel):
+class WebServerModel(BaseModel):
     SERVER_STARTED: str
     SERVER_STOPPED: str
     GET_REQUEST: str
@@ -32,11 +33,16 @@ class FlaskServerModel(BaseModel):
     NOT_CONNECTED: str
     RETURNING_HUB_CHALLENGE: str
     WEBHOOK_RECIEVED: str
+    BAD_WEBHOOK: str
 
 
 class TokenHandlerModel(BaseModel):
     GOOD_RESPONSE_FROM_API: str
     BAD_RESPONSE_FROM_API: str
+    CACHE_REFRESHED: str
+    CACHE_REFRESH_FAILED: str
+    CACHE_ERROR: str
+    CACHE_STALE: str
 
 
 class WebhookHandlerModel(BaseModel):
@@ -63,6 +69,8 @@ class ApiHandlerModel(BaseModel):
     GPX_STARTED: str
     GPX_RETRIEVE_ERROR: str
     GPX_CREATED: str
+    ACTIVITIES_SYNC: str
+    BACKFILL_FAILED: str
 
 
 class FormatHandlerModel(BaseModel):
@@ -74,7 +82,7 @@ class ImageHandlerModel(BaseModel):
     CANT_GET_IMAGE_URL: str
     CANT_GET_POLYLINE: str
     SAVED_IMAGE: str
-    SAVED_ROUTE: str
+    ROUTE_DRAWN: str
     PACE_CALCULATED: str
     SPEED_CALCULATED: str
     STATS_PREPARED: str
@@ -84,9 +92,7 @@ class ImageHandlerModel(BaseModel):
     STATS_ADDED: str
     CANT_ADD_IMAGE: str
     CALCULATED_SCALE: str
-    RESIZED_ROUTE: str
     STORY_CREATED: str
-    CANT_REMOVE_FILES: str
     RESIZED_IMAGE: str
     CALCULATED_OFFSETS: str
 
@@ -96,25 +102,92 @@ class AnalyticsHandlerModel(BaseModel):
     RIDE_COUNT: str
     RUN_COUNT: str
     DAILY_INCREASE: str
+    FORECAST_CACHED: str
+    BAD_ACTIVITY: str
+    NO_FORECAST_DATA: str
 
 
 class BotModel(BaseModel):
     LOG_MESSAGE: str
     LOG_CALLBACK: str
     GPX_SENT: str
-    GPX_DELETED: str
-    CANT_DELETE_GPX: str
     STORY_SENT: str
-    STORY_DELETED: str
-    CANT_DELETE_STORY: str
     FORECAST_SENT: str
-    FORECAST_DELETED: str
-    CANT_DELETE_FORECAST: str
+    WEBHOOK_SET: str
+    UPDATES_ABANDONED: str
+    JOB_REJECTED: str
+
+
+class HttpHandlerModel(BaseModel):
+    SESSION_CREATED: str
+    ASYNC_SESSION_CREATED: str
+    ASYNC_SESSION_CLOSED: str
+    CALL_COALESCED: str
+
+
+class StoreHandlerModel(BaseModel):
+    ACTIVITIES_SAVED: str
+    ACTIVITY_DELETED: str
+    ATHLETE_DELETED: str
+
+
+class RatelimitHandlerModel(BaseModel):
+    CALL_QUEUED: str
+    BAD_HEADERS: str
+    LIMIT_EXCEEDED: str
+
+
+class CacheHandlerModel(BaseModel):
+    CACHE_HIT: str
+    INVALIDATED: str
+
+
+class QueueHandlerModel(BaseModel):
+    EVENT_DROPPED: str
+
+
+class EventsHandlerModel(BaseModel):
+    EVENT_HANDLED: str
+    EVENT_FAILED: str
+    QUEUE_ERROR: str
+
+
+class RenderHandlerModel(BaseModel):
+    QUEUE_FULL: str
+    JOB_TIMEOUT: str
+    JOB_FAILED: str
+    POOL_BROKEN: str
+
+
+class AssetsHandlerModel(BaseModel):
+    ASSETS_LOADED: str
+
+
+class StoryCacheHandlerModel(BaseModel):
+    IMAGE_HIT: str
+
+
+class FileIdHandlerModel(BaseModel):
+    FILE_ID_HIT: str
+    FILE_IDS_DELETED: str
+    FILE_IDS_PURGED: str
+    PURGE_FAILED: str
+
+
+class FsmStorageHandlerModel(BaseModel):
+    STATES_PURGED: str
+    PURGE_FAILED: str
+
+
+class JanitorHandlerModel(BaseModel):
+    SWEPT: str
+    CLEANED: str
+    CANT_DELETE: str
 
 
 class AllTemplates(BaseModel):
     database_handler: DatabaseHandlerModel
-    flask_server: FlaskServerModel
+    web_server: WebServerModel
     token_handler: TokenHandlerModel
     webhook_handler: WebhookHandlerModel
     api_handler: ApiHandlerModel
@@ -122,6 +195,18 @@ class AllTemplates(BaseModel):
     image_handler: ImageHandlerModel
     analytics_handler: AnalyticsHandlerModel
     bot: BotModel
+    http_handler: HttpHandlerModel
+    store_handler: StoreHandlerModel
+    ratelimit_handler: RatelimitHandlerModel
+    cache_handler: CacheHandlerModel
+    queue_handler: QueueHandlerModel
+    events_handler: EventsHandlerModel
+    render_handler: RenderHandlerModel
+    assets_handler: AssetsHandlerModel
+    story_cache_handler: StoryCacheHandlerModel
+    file_id_handler: FileIdHandlerModel
+    fsm_storage_handler: FsmStorageHandlerModel
+    janitor_handler: JanitorHandlerModel
 
     def __getitem__(self, key):
         return getattr(self, key)
@@ -0,0 +1,8 @@
+"""Entry point of the bot. The render workers are spawned with this module
+as their __main__, so it must stay free of the bot state, which is created
+only when the bot module is imported."""
+
+if __name__ == "__main__":
+    from bot import main
+
+    main()
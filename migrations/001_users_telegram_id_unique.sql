@@ -0,0 +1,7 @@
+-- Keeps only the latest row for every telegram_id and adds the unique index,
+-- which is required for the INSERT ... ON CONFLICT upserts of the users.
+DELETE FROM users a
+    USING users b
+    WHERE a.telegram_id = b.telegram_id AND a.id < b.id;
+
+CREATE UNIQUE INDEX IF NOT EXISTS ix_users_telegram_id ON users (telegram_id);
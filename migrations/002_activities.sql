@@ -0,0 +1,19 @@
+-- Local copy of the athletes' activity summaries and the state
+-- of the incremental sync with Strava API for every athlete.
+CREATE TABLE IF NOT EXISTS activities (
+    strava_id BIGINT NOT NULL,
+    activity_id BIGINT NOT NULL,
+    start_date INTEGER NOT NULL,
+    summary JSONB NOT NULL,
+    PRIMARY KEY (strava_id, activity_id)
+);
+
+CREATE INDEX IF NOT EXISTS ix_activities_strava_id_start_date
+    ON activities (strava_id, start_date);
+
+CREATE TABLE IF NOT EXISTS activity_sync (
+    strava_id BIGINT PRIMARY KEY,
+    synced_from INTEGER NOT NULL,
+    last_start INTEGER NOT NULL,
+    synced_at INTEGER NOT NULL
+);
@@ -0,0 +1,10 @@
+-- Telegram file_id of the artifacts (GPX files, stories and forecasts)
+-- sent by the bot, so they can be sent again without uploading.
+CREATE TABLE IF NOT EXISTS file_ids (
+    key VARCHAR PRIMARY KEY,
+    file_id VARCHAR NOT NULL,
+    created_at INTEGER NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS ix_file_ids_key_pattern
+    ON file_ids (key varchar_pattern_ops);
@@ -0,0 +1,13 @@
+-- aiogram FSM states and data of the users, shared by the bot processes.
+-- States, which weren't updated for FSM_STATE_TTL, are expired.
+CREATE TABLE IF NOT EXISTS fsm_states (
+    chat_id BIGINT NOT NULL,
+    user_id BIGINT NOT NULL,
+    state VARCHAR,
+    data VARCHAR NOT NULL DEFAULT '{}',
+    updated_at INTEGER NOT NULL,
+    PRIMARY KEY (chat_id, user_id)
+);
+
+CREATE INDEX IF NOT EXISTS ix_fsm_states_updated_at
+    ON fsm_states (updated_at);
@@ -0,0 +1,4 @@
+-- file_id of the artifacts, which were sent more than FILE_ID_TTL ago,
+-- are purged, forecasts are sent with a new key every day.
+CREATE INDEX IF NOT EXISTS ix_file_ids_created_at
+    ON file_ids (created_at);
@@ -0,0 +1,98 @@
+import json
+import os
+import sqlite3
+
+from contextlib import closing
+from datetime import datetime
+
+from templates_handler import Constants
+from log_handler import Logger, LogTemplates
+
+logger = Logger(__name__)
+
+MAX_ATTEMPTS = 5
+# Time the taken events aren't available to other consumers. The events,
+# which weren't acknowledged in time (the consumer crashed), are taken again.
+LEASE = 5 * 60
+
+
+class EventQueue:
+    """Durable FIFO queue of the Strava webhook events in a local SQLite file.
+    Can be shared by processes: the web server puts the events and the
+    workers take and acknowledge them. Taken events are leased to the worker,
+    so each of them is handled by one worker at a time. Events, which failed,
+    are retried with a delay until MAX_ATTEMPTS is reached."""
+
+    def __init__(self, path: str):
+        self.path = path
+        with self.connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS events ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "event TEXT NOT NULL, "
+                "attempts INTEGER NOT NULL DEFAULT 0, "
+                "available_at REAL NOT NULL DEFAULT 0)"
+            )
+
+    def connect(self):
+        """Returns a new connection, which will be closed on exit."""
+        return closing(sqlite3.connect(self.path, timeout=5, isolation_level=None))
+
+    def put(self, event: dict) -> None:
+        with self.connect() as connection:
+            connection.execute(
+                "INSERT INTO events (event) VALUES (?)", (json.dumps(event),)
+            )
+
+    def take(self, limit: int) -> list:
+        """Claims up to limit available events for LEASE seconds and returns
+        them as (event_id, event) tuples."""
+        now = datetime.now().timestamp()
+        with self.connect() as connection:
+            # The write lock is taken before the select, so other consumers
+            # can't claim the same events.
+            connection.execute("BEGIN IMMEDIATE")
+            rows = connection.execute(
+                "SELECT id, event FROM events WHERE available_at <= ? "
+                "ORDER BY id LIMIT ?",
+                (now, limit),
+            ).fetchall()
+            connection.executemany(
+                "UPDATE events SET available_at = ? WHERE id = ?",
+                [(now + LEASE, event_id) for event_id, _ in rows],
+            )
+            connection.execute("COMMIT")
+        return [(event_id, json.loads(event)) for event_id, event in rows]
+
+    def ack(self, event_id: int) -> None:
+        with self.connect() as connection:
+            connection.execute("DELETE FROM events WHERE id = ?", (event_id,))
+
+    def retry(self, event_id: int, delay: int = 60) -> None:
+        """Postpones the failed event or drops it after MAX_ATTEMPTS."""
+        with self.connect() as connection:
+            connection.execute(
+                "UPDATE events SET attempts = attempts + 1, available_at = ? "
+                "WHERE id = ?",
+                (datetime.now().timestamp() + delay, event_id),
+            )
+            dropped = connection.execute(
+                "DELETE FROM events WHERE id = ? AND attempts >= ?",
+                (event_id, MAX_ATTEMPTS),
+            ).rowcount
+        if dropped:
+            logger.error(LogTemplates[__name__].EVENT_DROPPED.format(event_id))
+
+    def size(self) -> int:
+        with self.connect() as connection:
+            return connection.execute("SELECT COUNT(*) FROM events").fetchone()[0]
+
+
+def create_queue() -> EventQueue:
+    """Creates the webhook events queue, makes sure the directory exists."""
+    os.makedirs(os.path.dirname(Constants.QUEUE_PATH.value), exist_ok=True)
+    return EventQueue(Constants.QUEUE_PATH.value)
+
+
+event_queue = create_queue()
@@ -0,0 +1,165 @@
+import asyncio
+
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta, timezone
+
+from decouple import config
+
+from log_handler import Logger, LogTemplates
+
+logger = Logger(__name__)
+
+# Priorities of the API calls, lower value is served first.
+INTERACTIVE = 0
+BACKGROUND = 1
+
+SHORT_LIMIT = config("RATE_LIMIT_SHORT", default=200, cast=int)
+DAILY_LIMIT = config("RATE_LIMIT_DAILY", default=2000, cast=int)
+# Part of the limits, which background calls can use, the rest is reserved
+# for the interactive calls.
+BACKGROUND_SHARE = config("RATE_LIMIT_BACKGROUND_SHARE", default=0.8, cast=float)
+
+
+def next_resets() -> list:
+    """Returns the timestamps when the 15-minute and the daily windows
+    are reset (Strava resets them at quarter hours and midnight UTC)."""
+    now = datetime.now(timezone.utc)
+    quarter = now.replace(minute=now.minute - now.minute % 15, second=0, microsecond=0)
+    midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    short_reset = quarter + timedelta(minutes=15)
+    daily_reset = midnight + timedelta(days=1)
+    return [short_reset.timestamp(), daily_reset.timestamp()]
+
+
+class RateLimiter:
+    """Central scheduler for the Strava API calls. Keeps the budget of the
+    15-minute and the daily limits, which is updated from the X-RateLimit
+    headers of every response. When the budget is spent, the calls wait in
+    the queues by priority and the waiting users are served in turn, so
+    a burst from one user doesn't lock out everyone else."""
+
+    def __init__(self):
+        self.limits = [SHORT_LIMIT, DAILY_LIMIT]
+        self.usage = [0, 0]
+        self.resets = next_resets()
+        self.queues = {INTERACTIVE: OrderedDict(), BACKGROUND: OrderedDict()}
+        self.wakeup = None
+
+    def reset_windows(self) -> None:
+        """Resets the usage of the windows, which are already over."""
+        now = datetime.now(timezone.utc).timestamp()
+        resets = next_resets()
+        for window, reset in enumerate(self.resets):
+            if now >= reset:
+                self.usage[window] = 0
+                self.resets[window] = resets[window]
+
+    def available(self, priority: int) -> bool:
+        """Checks if the call with the specified priority fits the budget."""
+        self.reset_windows()
+        share = 1 if priority == INTERACTIVE else BACKGROUND_SHARE
+        return all(
+            usage < limit * share for usage, limit in zip(self.usage, self.limits)
+        )
+
+    def waiting(self, priority: int) -> bool:
+        """Checks if there are calls with the same or higher priority in queues."""
+        return any(
+            queue
+            for queue_priority, queue in self.queues.items()
+            if queue_priority <= priority
+        )
+
+    def take(self) -> None:
+        """Counts the granted call until the API reports the actual usage."""
+        self.usage = [usage + 1 for usage in self.usage]
+
+    async def acquire(self, telegram_id: int, priority: int = INTERACTIVE) -> None:
+        """Waits until the call of the user can be made."""
+        if not self.waiting(priority) and self.available(priority):
+            self.take()
+            return
+        future = asyncio.get_running_loop().create_future()
+        self.queues[priority].setdefault(telegram_id, deque()).append(future)
+        logger.debug(
+            LogTemplates[__name__].CALL_QUEUED.format(telegram_id, priority)
+        )
+        self.schedule_wakeup()
+        try:
+            await future
+        except asyncio.CancelledError:
+            futures = self.queues[priority].get(telegram_id)
+            if futures and future in futures:
+                futures.remove(future)
+                if not futures:
+                    del self.queues[priority][telegram_id]
+            raise
+
+    def dispatch(self) -> None:
+        """Grants the queued calls while the budget allows. Higher priority
+        goes first, users with the same priority are served round-robin."""
+        self.wakeup = None
+        for priority, queue in sorted(self.queues.items()):
+            while queue and self.available(priority):
+                telegram_id, futures = queue.popitem(last=False)
+                future = futures.popleft()
+                if futures:
+                    # Moving the user to the end of the line.
+                    queue[telegram_id] = futures
+                if future.done():
+                    continue
+                self.take()
+                future.set_result(None)
+            if queue:
+                break
+        self.schedule_wakeup()
+
+    def schedule_wakeup(self) -> None:
+        """Schedules dispatching at the next window reset if calls are waiting."""
+        if self.wakeup or not any(self.queues.values()):
+            return
+        delay = min(self.resets) - datetime.now(timezone.utc).timestamp()
+        self.wakeup = asyncio.get_running_loop().call_later(
+            max(delay, 0) + 1, self.dispatch
+        )
+
+    def update(self, headers: dict) -> None:
+        """Updates limits and usage from the API response headers."""
+        limits = headers.get("X-RateLimit-Limit")
+        usage = headers.get("X-RateLimit-Usage")
+        if not limits or not usage:
+            return
+        try:
+            self.limits = [int(value) for value in limits.split(",")][:2]
+            self.usage = [int(value) for value in usage.split(",")][:2]
+        except ValueError:
+            logger.warning(LogTemplates[__name__].BAD_HEADERS.format(limits, usage))
+            return
+        if self.wakeup:
+            self.wakeup.cancel()
+        self.dispatch()
+
+    def exhaust(self) -> None:
+        """Marks the 15-minute window as spent, used on 429 response."""
+        logger.warning(LogTemplates[__name__].LIMIT_EXCEEDED.format(self.usage))
+        self.usage[0] = max(self.usage[0], self.limits[0])
+
+    def status(self) -> dict:
+        """Returns current usage of the limits and the number of waiting calls."""
+        self.reset_windows()
+        return {
+            "short_usage": self.usage[0],
+            "short_limit": self.limits[0],
+            "short_percent": round(self.usage[0] / self.limits[0] * 100, 1),
+            "daily_usage": self.usage[1],
+            "daily_limit": self.limits[1],
+            "daily_percent": round(self.usage[1] / self.limits[1] * 100, 1),
+            "queued": sum(
+                len(futures)
+                for queue in self.queues.values()
+                for futures in queue.values()
+            ),
+        }
+
+
+rate_limiter = RateLimiter()
@@ -0,0 +1,126 @@
+import asyncio
+import multiprocessing
+import os
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+
+from decouple import config
+
+from analytics_handler import YearForecast
+from assets_handler import load_assets
+from image_handler import Stories
+from log_handler import Logger, LogTemplates
+
+logger = Logger(__name__)
+
+RENDER_WORKERS = config("RENDER_WORKERS", default=os.cpu_count() or 1, cast=int)
+# Maximum number of the jobs, which are running or waiting for a worker.
+RENDER_QUEUE_LIMIT = config("RENDER_QUEUE_LIMIT", default=RENDER_WORKERS * 4, cast=int)
+RENDER_TIMEOUT = config("RENDER_TIMEOUT", default=60, cast=int)
+
+
+class RenderBusy(Exception):
+    """Raised when the render queue is full."""
+
+
+def render_story(
+    telegram_id: int, activity_id: int, lang: str, raw_data: dict
+) -> BytesIO | None:
+    """Creates the story image, returns the buffer with it."""
+    return Stories(telegram_id, activity_id, lang, raw_data=raw_data).create_story()
+
+
+def render_forecasts(forecast: YearForecast, forecast_types: list, lang: str) -> list:
+    """Creates the forecast images of the types in the language in one job,
+    returns the list of the buffers with them."""
+    return [
+        forecast.create_forecast(forecast_type, lang)
+        for forecast_type in forecast_types
+    ]
+
+
+class RenderService:
+    """Runs CPU-heavy rendering (matplotlib and PIL) in a pool of worker
+    processes, so renders use all the cores and don't block the event loop.
+    The number of pending jobs is limited and every job has a timeout."""
+
+    def __init__(self, workers: int, queue_limit: int, timeout: int):
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self.timeout = timeout
+        self.pending = 0
+        self.executor = None
+
+    def get_executor(self) -> ProcessPoolExecutor:
+        """Creates the pool on the first job. Workers are spawned, so they
+        don't inherit the event loop, threads and connections of the bot,
+        and preload the assets at startup. Spawned workers import the main
+        module (main.py) and the modules of the render functions, which
+        must not create any bot state."""
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=load_assets,
+            )
+        return self.executor
+
+    async def run(self, function, *args):
+        """Runs the render function in the pool and returns its result,
+        or None if the job failed or didn't finish in time. The pool is
+        dropped if a worker died, so the next job creates a new one.
+        Raises RenderBusy if the queue is full. The job is counted until it
+        finishes in the worker, even if the caller stopped waiting for it,
+        so slow jobs can't take all the workers over the limit."""
+        if self.pending >= self.queue_limit:
+            logger.warning(LogTemplates[__name__].QUEUE_FULL.format(self.pending))
+            raise RenderBusy
+        self.pending += 1
+        loop = asyncio.get_running_loop()
+        executor = self.get_executor()
+        try:
+            future = loop.run_in_executor(executor, function, *args)
+        except BrokenProcessPool as error:
+            self.pending -= 1
+            self.drop_executor(executor, error)
+            return None
+        except Exception:
+            self.pending -= 1
+            raise
+        future.add_done_callback(self.release)
+        try:
+            # Shielded, so the timeout doesn't release the job in the worker.
+            return await asyncio.wait_for(asyncio.shield(future), self.timeout)
+        except asyncio.TimeoutError:
+            logger.error(
+                LogTemplates[__name__].JOB_TIMEOUT.format(
+                    function.__name__, self.timeout
+                )
+            )
+        except BrokenProcessPool as error:
+            self.drop_executor(executor, error)
+        except Exception as error:
+            logger.error(
+                LogTemplates[__name__].JOB_FAILED.format(function.__name__, error)
+            )
+
+    def release(self, future: asyncio.Future) -> None:
+        self.pending -= 1
+
+    def drop_executor(self, executor: ProcessPoolExecutor, error: Exception) -> None:
+        """Drops the broken pool, unless another job already replaced it."""
+        if self.executor is not executor:
+            return
+        logger.error(LogTemplates[__name__].POOL_BROKEN.format(error))
+        executor.shutdown(wait=False, cancel_futures=True)
+        self.executor = None
+
+    def shutdown(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+
+render_service = RenderService(RENDER_WORKERS, RENDER_QUEUE_LIMIT, RENDER_TIMEOUT)
@@ -0,0 +1,105 @@
+from datetime import datetime, timezone
+
+from sqlalchemy.dialects.postgresql import insert
+
+from database_handler import Session, Activities, ActivitySync
+from log_handler import Logger, LogTemplates
+
+logger = Logger(__name__)
+
+
+def start_timestamp(activity: dict) -> int:
+    """Returns the activity start time (UTC) as epoch timestamp,
+    the same value the API uses for after and before filters."""
+    start_date = datetime.strptime(activity["start_date"], "%Y-%m-%dT%H:%M:%SZ")
+    return int(start_date.replace(tzinfo=timezone.utc).timestamp())
+
+
+def get_sync(strava_id: int) -> dict | None:
+    """Returns the sync state for the athlete or None if it was never synced."""
+    with Session() as session:
+        sync = session.get(ActivitySync, strava_id)
+        if sync:
+            return {
+                "synced_from": sync.synced_from,
+                "last_start": sync.last_start,
+                "synced_at": sync.synced_at,
+            }
+
+
+def save_sync(strava_id: int, sync: dict) -> None:
+    """Upserts the sync state of the athlete."""
+    with Session() as session:
+        statement = insert(ActivitySync).values(strava_id=strava_id, **sync)
+        statement = statement.on_conflict_do_update(
+            index_elements=[ActivitySync.strava_id], set_=sync
+        )
+        session.execute(statement)
+        session.commit()
+
+
+def save_activities(strava_id: int, activities: list) -> None:
+    """Upserts the activity summaries of the athlete."""
+    if not activities:
+        return
+    with Session() as session:
+        statement = insert(Activities).values(
+            [
+                {
+                    "strava_id": strava_id,
+                    "activity_id": activity["id"],
+                    "start_date": start_timestamp(activity),
+                    "summary": activity,
+                }
+                for activity in activities
+            ]
+        )
+        statement = statement.on_conflict_do_update(
+            index_elements=[Activities.strava_id, Activities.activity_id],
+            set_={
+                "start_date": statement.excluded.start_date,
+                "summary": statement.excluded.summary,
+            },
+        )
+        session.execute(statement)
+        session.commit()
+    logger.debug(
+        LogTemplates[__name__].ACTIVITIES_SAVED.format(len(activities), strava_id)
+    )
+
+
+def get_activities(strava_id: int, after: int = None, before: int = None) -> list:
+    """Returns stored activity summaries in the specified period of time,
+    newest first (same order as the API returns them)."""
+    with Session() as session:
+        query = session.query(Activities.summary).filter(
+            Activities.strava_id == strava_id
+        )
+        if after:
+            query = query.filter(Activities.start_date > after)
+        if before:
+            query = query.filter(Activities.start_date < before)
+        return [
+            summary for summary, in query.order_by(Activities.start_date.desc())
+        ]
+
+
+def delete_activity(strava_id: int, activity_id: int) -> None:
+    """Deletes the activity from the store."""
+    with Session() as session:
+        session.query(Activities).filter_by(
+            strava_id=strava_id, activity_id=activity_id
+        ).delete()
+        session.commit()
+    logger.debug(
+        LogTemplates[__name__].ACTIVITY_DELETED.format(activity_id, strava_id)
+    )
+
+
+def delete_athlete(strava_id: int) -> None:
+    """Deletes all the stored activities and the sync state of the athlete."""
+    with Session() as session:
+        session.query(Activities).filter_by(strava_id=strava_id).delete()
+        session.query(ActivitySync).filter_by(strava_id=strava_id).delete()
+        session.commit()
+    logger.debug(LogTemplates[__name__].ATHLETE_DELETED.format(strava_id))
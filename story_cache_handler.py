@@ -0,0 +1,46 @@
+import os
+
+from io import BytesIO
+
+from janitor_handler import janitor
+from templates_handler import Constants
+from log_handler import Logger, LogTemplates
+
+logger = Logger(__name__)
+
+
+class StoryCache:
+    """Cache of the rendered stories keyed by image_handler.story_key(), so
+    a story is rendered again only when anything drawn on it changes.
+    Stories are deleted by the janitor when they aren't used for a while."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.png")
+
+    def exists(self, key: str) -> bool:
+        return os.path.exists(self.path(key))
+
+    def get_image(self, key: str) -> BytesIO | None:
+        try:
+            with open(self.path(key), "rb") as story_file:
+                story = BytesIO(story_file.read())
+        except FileNotFoundError:
+            return None
+        logger.debug(LogTemplates[__name__].IMAGE_HIT.format(key))
+        # Stories in use are kept longer.
+        janitor.track(self.path(key))
+        return story
+
+    def save_image(self, key: str, story: BytesIO) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        # Written under the temporary name, so a partial file is never read.
+        with open(f"{self.path(key)}.tmp", "wb") as story_file:
+            story_file.write(story.getbuffer())
+        os.replace(f"{self.path(key)}.tmp", self.path(key))
+        janitor.track(self.path(key))
+
+
+story_cache = StoryCache(Constants.STORIES_CACHE.value)
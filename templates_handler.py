@@ -28,13 +28,21 @@ class Urls(Enum):
 class Constants(Enum):
     ABSOLUTE_PATH = os.path.dirname(__file__)
     IMAGE_PATH = os.path.join(ABSOLUTE_PATH, "images")
+    STORIES_CACHE = os.path.join(ABSOLUTE_PATH, "images", "stories")
     STORIES_TEMPLATES = os.path.join(ABSOLUTE_PATH, "templates", "stories")
     FORECASTS_TEMPLATES = os.path.join(ABSOLUTE_PATH, "templates", "forecasts")
     FONTS_DIR = os.path.join(ABSOLUTE_PATH, "templates", "fonts")
-    DIRS = ["logs", "gpx", "images"]
+    MIGRATIONS_DIR = os.path.join(ABSOLUTE_PATH, "migrations")
+    QUEUE_PATH = os.path.join(ABSOLUTE_PATH, "queue", "webhooks.sqlite")
+    FSM_PATH = os.path.join(ABSOLUTE_PATH, "fsm", "states.sqlite")
+    DIRS = ["logs", "images", os.path.join("images", "stories"), "queue", "fsm"]
     SUPPORTED_LANGUAGES = ["en", "ru"]
 
 
 def startup():
     for d in Constants.DIRS.value:
         os.makedirs(os.path.join(Constants.ABSOLUTE_PATH.value, d), exist_ok=True)
+    # Imported here, since the janitor uses the constants of this module.
+    from janitor_handler import janitor
+
+    janitor.sweep()
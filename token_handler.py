@@ -1,7 +1,11 @@
-import requests
+import asyncio
+import threading
 
+from datetime import datetime
 from decouple import config
 
+from database_handler import DatabaseSession
+from http_handler import get_session, get_async_session
 from log_handler import Logger, LogTemplates
 from format_handler import Urls
 
@@ -18,9 +22,8 @@ class Token():
         self.refresh_token = refresh_token
         self.code = code
 
-    def exchange(self) -> None:
-        """Exchange tokens (code or refresh token for access token) and
-        writes it into the database."""
+    def request_data(self) -> dict:
+        """Returns the form of the token exchange request."""
         data = {
             'client_id': self.client_id,
             'client_secret': self.client_secret,
@@ -31,22 +34,154 @@ class Token():
         else:
             data['code'] = self.code
             data['grant_type'] = 'authorization_code'
-        raw_response = requests.post(Urls.STRAVA_API, data=data)
+        return data
+
+    def exchange(self) -> dict | None:
+        """Exchange tokens (code or refresh token for access token) and
+        returns the auth data for the database."""
+        raw_response = get_session().post(
+            Urls.STRAVA_API, data=self.request_data())
         if raw_response.status_code == 200:
-            response = raw_response.json()
-            logger.info(LogTemplates[__name__].GOOD_RESPONSE_FROM_API.format(
-                self.telegram_id))
-            auth_data = {
-                "telegram_id": self.telegram_id,
-            }
-            if self.code:
-                auth_data.update({"strava_id": response['athlete']['id']})
-            auth_data.update({
-                "token_type": response['token_type'],
-                "access_token": response['access_token'],
-                "expires_at": response['expires_at'],
-                "refresh_token": response['refresh_token']})
-            return auth_data
-        else:
-            logger.error(LogTemplates[__name__].BAD_RESPONSE_FROM_API.format(
-                self.telegram_id))
+            return self.auth_data(raw_response.json())
+        logger.error(LogTemplates[__name__].BAD_RESPONSE_FROM_API.format(
+            self.telegram_id))
+
+    async def async_exchange(self) -> dict | None:
+        """Same as exchange(), but uses the shared aiohttp session,
+        so it doesn't block the event loop."""
+        async with get_async_session().post(
+                Urls.STRAVA_API, data=self.request_data()) as raw_response:
+            if raw_response.status == 200:
+                return self.auth_data(await raw_response.json())
+        logger.error(LogTemplates[__name__].BAD_RESPONSE_FROM_API.format(
+            self.telegram_id))
+
+    def auth_data(self, response: dict) -> dict:
+        """Returns the auth data from the token exchange response."""
+        logger.info(LogTemplates[__name__].GOOD_RESPONSE_FROM_API.format(
+            self.telegram_id))
+        auth_data = {
+            "telegram_id": self.telegram_id,
+        }
+        if self.code:
+            auth_data.update({"strava_id": response['athlete']['id']})
+        auth_data.update({
+            "token_type": response['token_type'],
+            "access_token": response['access_token'],
+            "expires_at": response['expires_at'],
+            "refresh_token": response['refresh_token']})
+        return auth_data
+
+
+class TokenCache:
+    """In-process cache of the users' access tokens, keyed by telegram_id.
+    Entries are filled from the Users table and live for ttl seconds.
+    Tokens, which are about to expire, are refreshed in the background
+    by refresh_expiring(), so API calls don't need the database."""
+    def __init__(self, ttl: int, refresh_margin: int):
+        self.ttl = ttl
+        self.refresh_margin = refresh_margin
+        self.tokens = {}
+        # Incremented on every invalidation, so the entries read before it
+        # (from the database or the API) aren't cached afterwards.
+        self.generations = {}
+        self.lock = threading.Lock()
+
+    def get(self, telegram_id: int) -> dict | None:
+        """Returns cached token data or None if it's stale or expires
+        in the next 60 minutes (same rule as in the DatabaseSession)."""
+        now = datetime.now().timestamp()
+        with self.lock:
+            entry = self.tokens.get(telegram_id)
+        if not entry or now > entry['cached_at'] + self.ttl:
+            return None
+        if now > entry['expires_at'] - (60 * 60):
+            return None
+        return entry
+
+    def generation(self, telegram_id: int) -> int:
+        """Returns the generation to pass to set() for the data read after
+        this call."""
+        with self.lock:
+            return self.generations.get(telegram_id, 0)
+
+    def set(self, telegram_id: int, strava_id: int, access_token: str,
+            refresh_token: str, expires_at: int,
+            generation: int = None) -> None:
+        """Caches the token data. If the generation is given and the user
+        was invalidated since, the data is stale and isn't cached."""
+        with self.lock:
+            if generation is not None and \
+                    generation != self.generations.get(telegram_id, 0):
+                return
+            self.tokens[telegram_id] = {
+                'strava_id': strava_id,
+                'access_token': access_token,
+                'refresh_token': refresh_token,
+                'expires_at': expires_at,
+                'cached_at': datetime.now().timestamp()}
+
+    def invalidate(self, telegram_id: int) -> None:
+        """Drops the entry of the user, who was re-authorized or deleted.
+        Reads and refreshes in process won't cache the old tokens."""
+        with self.lock:
+            self.tokens.pop(telegram_id, None)
+            self.generations[telegram_id] = \
+                self.generations.get(telegram_id, 0) + 1
+
+    def refresh_expiring(self) -> None:
+        """Drops stale entries and refreshes tokens, which will expire
+        in the refresh margin, updating both the cache and the database."""
+        now = datetime.now().timestamp()
+        with self.lock:
+            for telegram_id in [
+                    telegram_id for telegram_id, entry in self.tokens.items()
+                    if now > entry['cached_at'] + self.ttl]:
+                del self.tokens[telegram_id]
+            expiring = {
+                telegram_id: entry for telegram_id, entry
+                in self.tokens.items()
+                if now > entry['expires_at'] - self.refresh_margin}
+            generations = {
+                telegram_id: self.generations.get(telegram_id, 0)
+                for telegram_id in expiring}
+        for telegram_id, entry in expiring.items():
+            token = Token(telegram_id, refresh_token=entry['refresh_token'])
+            auth_data = token.exchange()
+            if not auth_data:
+                logger.error(
+                    LogTemplates[__name__].CACHE_REFRESH_FAILED.format(
+                        telegram_id))
+                self.invalidate(telegram_id)
+                continue
+            with DatabaseSession(telegram_id) as update_session:
+                updated = update_session.refresh_user(
+                    auth_data, entry['strava_id'], entry['refresh_token'])
+            if not updated:
+                # The user was re-authorized, the cached entry is stale.
+                logger.warning(LogTemplates[__name__].CACHE_STALE.format(
+                    telegram_id))
+                self.invalidate(telegram_id)
+                continue
+            self.set(telegram_id, entry['strava_id'],
+                     auth_data['access_token'], auth_data['refresh_token'],
+                     auth_data['expires_at'], generations[telegram_id])
+            logger.debug(LogTemplates[__name__].CACHE_REFRESHED.format(
+                telegram_id))
+
+
+token_cache = TokenCache(
+    ttl=config('TOKEN_CACHE_TTL', default=60 * 60, cast=int),
+    refresh_margin=config('TOKEN_REFRESH_MARGIN', default=2 * 60 * 60,
+                          cast=int))
+
+
+async def refresh_tokens(interval: int = 5 * 60) -> None:
+    """Background task, which periodically refreshes expiring tokens
+    in the token cache."""
+    while True:
+        try:
+            await asyncio.to_thread(token_cache.refresh_expiring)
+        except Exception as error:
+            logger.error(LogTemplates[__name__].CACHE_ERROR.format(error))
+        await asyncio.sleep(interval)
@@ -0,0 +1,172 @@
+import asyncio
+import os
+
+from aiohttp import web
+from decouple import config
+from jinja2 import Environment, FileSystemLoader, select_autoescape
+
+from format_handler import get_template, get_content
+from database_handler import DatabaseSession
+from events_handler import forget_cached
+from log_handler import Logger, LogTemplates
+from token_handler import Token
+from templates_handler import Constants
+from queue_handler import event_queue
+
+SERVER_PORT = config("SERVER_PORT", default=80, cast=int)
+SHUTDOWN_TIMEOUT = config("SHUTDOWN_TIMEOUT", default=30, cast=int)
+PAGES_TEMPLATES = get_template("pages_templates")
+logger = Logger(__name__)
+
+# Pages are rendered from the Jinja templates in templates/pages.
+jinja = Environment(
+    loader=FileSystemLoader(os.path.join(Constants.ABSOLUTE_PATH.value, "templates")),
+    autoescape=select_autoescape(),
+)
+routes = web.RouteTableDef()
+runner = None
+
+
+def render_page(template: str, headers: dict = None, **kwargs) -> web.Response:
+    return web.Response(
+        text=jinja.get_template(template).render(**kwargs),
+        content_type="text/html",
+        headers=headers,
+    )
+
+
+@routes.get("/webhooks/")
+async def webhook_challenge(request: web.Request) -> web.Response:
+    logger.debug(LogTemplates[__name__].GET_REQUEST.format(request.path_qs))
+    verify_token = request.query.get("hub.verify_token")
+    if verify_token != config("VERIFY_TOKEN"):
+        raise web.HTTPForbidden()
+    hub_challenge = request.query.get("hub.challenge")
+    logger.debug(LogTemplates[__name__].RETURNING_HUB_CHALLENGE.format(hub_challenge))
+    return web.json_response({"hub.challenge": hub_challenge})
+
+
+@routes.post("/webhooks/")
+async def webhook_catcher(request: web.Request) -> web.Response:
+    if request.content_type == "application/json":
+        try:
+            json_data = await request.json()
+            if not isinstance(json_data, dict):
+                raise ValueError
+        except ValueError:
+            logger.warning(LogTemplates[__name__].BAD_WEBHOOK.format(request.remote))
+            raise web.HTTPBadRequest()
+        logger.info(LogTemplates[__name__].WEBHOOK_RECIEVED.format(json_data))
+        # Handled later by the events worker, the queue survives restarts.
+        await asyncio.to_thread(event_queue.put, json_data)
+    return web.Response()
+
+
+@routes.get("/stravagramoauth")
+async def oauth(request: web.Request) -> web.Response:
+    lang = locale_check(request)
+    context = PAGES_TEMPLATES["locale"][lang]
+    logger.debug(LogTemplates[__name__].GET_REQUEST.format(request.path_qs))
+    telegram_id = request.query.get("telegram_id")
+    code = request.query.get("code")
+    scope = request.query.get("scope", "")
+    if "activity:read_all" not in scope:
+        logger.debug(LogTemplates[__name__].BAD_REQUEST.format(telegram_id))
+        message = PAGES_TEMPLATES["locale"][lang]["oauth_bad_message"]
+        result = PAGES_TEMPLATES["locale"][lang]["oauth_bad"]
+        return render_page(
+            "pages/oauth.html", context=context, result=result, message=message
+        )
+    else:
+        logger.debug(LogTemplates[__name__].GOOD_REQUEST.format(telegram_id, code))
+        await oauth_init(telegram_id, code)
+        message = PAGES_TEMPLATES["locale"][lang]["oauth_good_message"]
+        result = PAGES_TEMPLATES["locale"][lang]["oauth_good"]
+        return render_page(
+            "pages/oauth.html",
+            headers={"Refresh": "5; url=/"},
+            context=context,
+            result=result,
+            message=message,
+        )
+
+
+@routes.get("/")
+async def index_page(request: web.Request) -> web.Response:
+    lang = locale_check(request)
+    context = PAGES_TEMPLATES["locale"][lang]
+    return render_page("pages/index.html", context=context)
+
+
+@routes.get("/about")
+@routes.get("/changelog")
+async def pages(request: web.Request) -> web.Response:
+    lang = locale_check(request)
+    context = PAGES_TEMPLATES["locale"][lang]
+    content = get_content(request.path, lang)
+    return render_page(
+        "pages{}.html".format(request.path), context=context, content=content
+    )
+
+
+def locale_check(request: web.Request) -> str:
+    """Returns the language code of GET request, the supported language
+    with the highest quality in the Accept-Language header."""
+    languages = []
+    for item in request.headers.get("Accept-Language", "").split(","):
+        language, _, quality = item.strip().partition(";q=")
+        try:
+            quality = float(quality or 1)
+        except ValueError:
+            continue
+        languages.append((quality, language.split("-")[0].lower()))
+    for _, language in sorted(languages, key=lambda item: -item[0]):
+        if language in Constants.SUPPORTED_LANGUAGES.value:
+            return language
+    return "en"
+
+
+async def oauth_init(telegram_id: int, code: str) -> None:
+    """Initiates token exchange procedure with code recieved from
+    OAuth GET request."""
+    token = Token(telegram_id, code=code)
+    auth_data = await token.async_exchange()
+    if auth_data:
+
+        def add_user():
+            with DatabaseSession(telegram_id) as oauth_session:
+                oauth_session.add_user(auth_data)
+
+        await asyncio.to_thread(add_user)
+        # The user could be re-authorized with another Strava account.
+        await forget_cached(int(telegram_id))
+    else:
+        logger.error(LogTemplates[__name__].OAUTH_FAILED)
+
+
+def create_app() -> web.Application:
+    app = web.Application()
+    app.add_routes(routes)
+    return app
+
+
+async def start_server() -> None:
+    """Starts the server on the running event loop, so it shares the HTTP
+    session, the database pool and the caches with the bot."""
+    global runner
+    runner = web.AppRunner(create_app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(
+        runner, "0.0.0.0", SERVER_PORT, shutdown_timeout=SHUTDOWN_TIMEOUT
+    ).start()
+    logger.info(LogTemplates[__name__].SERVER_STARTED.format(SERVER_PORT))
+
+
+async def stop_server() -> None:
+    """Stops accepting requests and waits for the ones in process."""
+    global runner
+    if runner is None:
+        return
+    await runner.cleanup()
+    runner = None
+    logger.warning(LogTemplates[__name__].SERVER_STOPPED)
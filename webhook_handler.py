@@ -1,6 +1,5 @@
-import requests
-
 from decouple import config
+from http_handler import get_session
 from log_handler import Logger, LogTemplates
 
 logger = Logger(__name__)
@@ -29,7 +28,7 @@ class WebHook:
             'verify_token': self.verify_token,
         })
         logger.debug(LogTemplates[__name__].SUBSCRIBE_REQUESTED)
-        response = requests.post(self.api_url, data=data)
+        response = get_session().post(self.api_url, data=data)
         if response.status_code == 201:
             response = response.json()
             logger.debug(LogTemplates[__name__].API_RESPONDED.format(
@@ -49,7 +48,7 @@ class WebHook:
         """Making request to check if the active subscription is exists.
         Returns subscription id or None."""
         logger.debug(LogTemplates[__name__].VIEW_REQUESTED)
-        response = requests.get(self.api_url, params=self.params)
+        response = get_session().get(self.api_url, params=self.params)
         if response.status_code == 200:
             response = response.json()
             try:
@@ -69,7 +68,7 @@ class WebHook:
         of request result."""
         self.view()
         logger.debug(LogTemplates[__name__].DELETE_REQUESTED)
-        response = requests.delete(self.api_url + '/{}'.format(
+        response = get_session().delete(self.api_url + '/{}'.format(
             self.subcription_id), params=self.params)
         if response.status_code == 204:
             logger.debug(LogTemplates[__name__].SUB_DELETED)